@@ -1,12 +1,23 @@
+import contextlib
+import hashlib
+import random
+import time
 import requests
 import utils.misc
+from utils import blobcache, db, ratelimit
+from concurrent.futures import ThreadPoolExecutor
 from titlecase import titlecase
 
-from config import IVLE_APIKEY, IVLE_TIMEOUT
+from config import IVLE_APIKEY, IVLE_TIMEOUT, IVLE_CRAWL_CONCURRENCY, IVLE_MAX_REQUESTS, IVLE_FULL_CRAWL_INTERVAL, \
+    IVLE_WORKBIN_CACHE_TTL, IVLE_TOKEN_VALIDATED_TTL, TRANSFER_CHUNK_SIZE, FILE_TRANSFER_CONCURRENCY, BLOB_LOCK_EXPIRE
+
+# One keep-alive session per process, so consecutive IVLE calls reuse their connections.
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max(10, IVLE_CRAWL_CONCURRENCY, FILE_TRANSFER_CONCURRENCY)))
 
 
 def get_user_id_and_email(token):
-    request = requests.get(
+    request = session.get(
         'https://ivle.nus.edu.sg/api/Lapi.svc/Profile_View?APIKey=%s&AuthToken=%s' % (IVLE_APIKEY, token), timeout=IVLE_TIMEOUT)
     data = request.json()['Results'][0]
     return {x: data[x] for x in ['UserID', 'Email']}
@@ -17,7 +28,7 @@ def get_ivle_login_url(callback_url):
 
 
 def get_modules_list(user):
-    request = requests.get('https://ivle.nus.edu.sg/api/Lapi.svc/Modules?APIKey=%s&AuthToken=%s&Duration=0&IncludeAllInfo=false' % (
+    request = session.get('https://ivle.nus.edu.sg/api/Lapi.svc/Modules?APIKey=%s&AuthToken=%s&Duration=0&IncludeAllInfo=false' % (
         IVLE_APIKEY, user.ivle_token), timeout=IVLE_TIMEOUT)
     if request.json()['Comments'] == 'Invalid login!':
         raise Exception()  # TODO
@@ -31,15 +42,22 @@ def get_modules_list(user):
 
 def validate_token(user):  # Due to IVLE bugs we temporarily dirty hack here
     try:
-        result = requests.get('https://ivle.nus.edu.sg/api/Lapi.svc/Validate?APIKey=%s&Token=%s' % (IVLE_APIKEY, user.ivle_token), timeout=IVLE_TIMEOUT).json()
+        ratelimit.acquire(['ivle'])
+        result = session.get('https://ivle.nus.edu.sg/api/Lapi.svc/Validate?APIKey=%s&Token=%s' % (IVLE_APIKEY, user.ivle_token), timeout=IVLE_TIMEOUT).json()
     except:
         return True  # TODO: IVLE API Bug Here
     if result['Success']:
+        db.set_token_validated(user.user_id, IVLE_TOKEN_VALIDATED_TTL)
         return True
     else:
+        db.clear_token_validated(user.user_id)
         return False
 
 
+class IVLEInvalidTokenException(Exception):
+    pass
+
+
 def parse_folder(user, folder, father_directory):
     file_list = []
     father_directory = father_directory.strip()
@@ -48,35 +66,97 @@ def parse_folder(user, folder, father_directory):
             for single_file in folder['Files']:
                 if not (utils.misc.is_ignored_file(single_file['FileName'])):
                     file_list.append({'path': father_directory + folder['FolderName'].strip(' .') + '/' + single_file['FileName'],
-                                      'ID': single_file['ID'], 'size': single_file['FileSize']})  # TODO: SIZE!
+                                      'ID': single_file['ID'], 'size': single_file['FileSize'],
+                                      'uploaded': single_file.get('UploadTime_js', 0)})  # TODO: SIZE!
         if len(folder['Folders']) > 0:
             for single_folder in folder['Folders']:
                 file_list.extend(parse_folder(user, single_folder, father_directory + folder['FolderName'].strip(' .') + '/'))
     return file_list
 
 
-def read_file_list(user, CourseCode, CourseID):
-    data = requests.get('https://ivle.nus.edu.sg/api/Lapi.svc/Workbins?APIKey=%s&AuthToken=%s&CourseID=%s&Duration=0&WorkbinID=&TitleOnly=false' % (
-        IVLE_APIKEY, user.ivle_token, CourseID), timeout=IVLE_TIMEOUT).json()
+@contextlib.contextmanager
+def request_slot():
+    # Caps the number of IVLE requests in flight across all workers at IVLE_MAX_REQUESTS, and their rate at RATE_LIMITS['ivle'].
+    ratelimit.acquire(['ivle'])
+    token = db.acquire_semaphore('IVLE', IVLE_MAX_REQUESTS, IVLE_TIMEOUT * 2)
+    while token is None:
+        time.sleep(random.uniform(0.1, 0.5))
+        token = db.acquire_semaphore('IVLE', IVLE_MAX_REQUESTS, IVLE_TIMEOUT * 2)
+    try:
+        yield
+    finally:
+        db.release_semaphore('IVLE', token)
+
+
+def fetch_workbins(user, CourseID, duration=0):
+    with request_slot():
+        request = session.get('https://ivle.nus.edu.sg/api/Lapi.svc/Workbins?APIKey=%s&AuthToken=%s&CourseID=%s&Duration=%d&WorkbinID=&TitleOnly=false' % (
+            IVLE_APIKEY, user.ivle_token, CourseID, duration), timeout=IVLE_TIMEOUT)
+    return request.json()['Results'], hashlib.sha1(request.content).hexdigest()
+
+
+def parse_workbins(user, CourseCode, workbins, multiple_workbins):
     file_list = []
-    if len(data['Results']) > 1:  # We treat modules with one or more workbins differently because we do not want to merge files in different workbins.
-        for workbin in data['Results']:
-            if len(workbin['Folders']) > 0:  # It is not allowed to have files in the root directory of a workbin.
-                for folder in workbin['Folders']:
-                    file_list.extend(parse_folder(user, folder, '/%s/%s/' % (
-                        utils.misc.module_code_safe_check(CourseCode), utils.misc.module_code_safe_check(workbin['Title']).strip(' .'))))
-    elif len(data['Results']) == 1:
-        workbin = data['Results'][0]
-        if len(workbin['Folders']) > 0:
-            for folder in workbin['Folders']:
-                file_list.extend(parse_folder(user, folder, '/%s/' % utils.misc.module_code_safe_check(CourseCode)))
+    for workbin in workbins:  # It is not allowed to have files in the root directory of a workbin.
+        if multiple_workbins:  # We treat modules with one or more workbins differently because we do not want to merge files in different workbins.
+            father_directory = '/%s/%s/' % (utils.misc.module_code_safe_check(CourseCode), utils.misc.module_code_safe_check(workbin['Title']).strip(' .'))
+        else:
+            father_directory = '/%s/' % utils.misc.module_code_safe_check(CourseCode)
+        for folder in workbin['Folders']:
+            file_list.extend(parse_folder(user, folder, father_directory))
     return file_list
 
 
+def refresh_file_list(user, CourseCode, CourseID, cache):
+    # Workbins rarely change, so most refreshes only ask IVLE for what changed since the last one (Duration is in minutes)
+    # and merge that into the cached listing. A full crawl every IVLE_FULL_CRAWL_INTERVAL picks up deletions and moves.
+    now = time.time()
+    if (not cache) or cache['code'] != CourseCode or now - cache['full_crawled'] > IVLE_FULL_CRAWL_INTERVAL:
+        workbins, payload_hash = fetch_workbins(user, CourseID)
+        if cache and cache['hash'] == payload_hash and cache['code'] == CourseCode:
+            file_list = cache['files']
+        else:
+            file_list = parse_workbins(user, CourseCode, workbins, len(workbins) > 1)
+        if cache and cache['files'] and not workbins:
+            file_list = cache['files']  # Someone who cannot see the course must not empty it for everyone else
+        cache = {'code': CourseCode, 'multiple_workbins': len(workbins) > 1, 'hash': payload_hash, 'full_crawled': now, 'files': file_list}
+    else:
+        workbins, payload_hash = fetch_workbins(user, CourseID, int((now - cache['crawled']) // 60) + 2)
+        if workbins:
+            changed_files = parse_workbins(user, CourseCode, workbins, cache['multiple_workbins'])
+            changed_ids = set(file['ID'] for file in changed_files)
+            cache['files'] = [file for file in cache['files'] if file['ID'] not in changed_ids] + changed_files
+    cache['crawled'] = now
+    return cache
+
+
+def read_file_list(user, CourseCode, CourseID):
+    # Everyone taking a course sees the same workbins, so listings are shared across users (per uploadable_folder setting)
+    # for IVLE_WORKBIN_CACHE_TTL, and only one worker at a time refreshes a course.
+    cache = db.get_workbin_cache(CourseID, user.uploadable_folder)
+    if cache and time.time() - cache['crawled'] < IVLE_WORKBIN_CACHE_TTL:
+        return cache['files']
+    lock = db.get_workbin_lock(CourseID, user.uploadable_folder, IVLE_TIMEOUT * 3)
+    if not lock.acquire(blocking=not cache):
+        return cache['files']  # Someone else is refreshing it, a slightly stale listing will do
+    try:
+        cache = db.get_workbin_cache(CourseID, user.uploadable_folder)  # It may have been refreshed while we were waiting
+        if not (cache and time.time() - cache['crawled'] < IVLE_WORKBIN_CACHE_TTL):
+            cache = refresh_file_list(user, CourseCode, CourseID, cache)
+            db.set_workbin_cache(CourseID, user.uploadable_folder, cache, IVLE_FULL_CRAWL_INTERVAL * 2)
+    finally:
+        lock.release()
+    return cache['files']
+
+
 def read_all_file_list(user):
+    if not (db.is_token_validated(user.user_id) or validate_token(user)):
+        raise IVLEInvalidTokenException()  # Cached listings are only handed out to users IVLE still accepts
+    with ThreadPoolExecutor(max_workers=IVLE_CRAWL_CONCURRENCY) as executor:
+        file_lists = list(executor.map(lambda module: read_file_list(user, module['Code'], module['ID']), user.modules))
     file_list = []
-    for module in user.modules:
-        file_list.extend(read_file_list(user, module['Code'], module['ID']))
+    for module_file_list in file_lists:
+        file_list.extend(module_file_list)
     return file_list
 
 
@@ -88,11 +168,91 @@ class IVLEUnknownErrorException(BaseException):
     pass
 
 
-def get_file(url):
-    request = requests.get(url)
-    if request.headers['Content-Type'] == 'text/html' and b'Your actions have caused an error' in request.content:
-        raise IVLEUnknownErrorException()  # TODO: IVLE Bug
-    elif request.status_code == 200:
-        return request.content
-    else:
+class IVLEFile():
+    # A forward-only reader over an IVLE download, so that a transfer only holds one chunk in memory at a time.
+    # size is None if IVLE does not tell us the length of the file.
+    def __init__(self, response):
+        self.response = response
+        self.buffer = b''
+        self.size = None
+        if 'Content-Length' in response.headers and not response.headers.get('Content-Encoding'):
+            self.size = int(response.headers['Content-Length'])
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(self)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        while len(data) < size:  # raw.read() may return less than asked for before EOF
+            chunk = self.response.raw.read(size - len(data), decode_content=True)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(TRANSFER_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def skip(self, size):  # Reads past size bytes a chunk at a time
+        while size > 0:
+            chunk = self.read(min(size, TRANSFER_CHUNK_SIZE))
+            if not chunk:
+                return
+            size -= len(chunk)
+
+    def peek(self, size):
+        if len(self.buffer) < size:
+            self.buffer += self.response.raw.read(size - len(self.buffer), decode_content=True)
+        return self.buffer[:size]
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_file(url):
+    ratelimit.acquire(['ivle'])
+    request = session.get(url, stream=True, timeout=IVLE_TIMEOUT)
+    if request.status_code != 200:
+        request.close()
         raise IVLEUnknownErrorException()  # TODO: A lot of IVLE Bugs
+    file = IVLEFile(request)
+    if request.headers.get('Content-Type') == 'text/html' and b'Your actions have caused an error' in file.peek(64 * 1024):
+        file.close()
+        raise IVLEUnknownErrorException()  # TODO: IVLE Bug
+    return file
+
+
+class WorkbinFile():
+    # A workbin file as handed to the drivers. The same file of a course has the same ID for everyone taking it, so cache_key
+    # identifies its content across users; open() downloads it from IVLE once and every transfer after that reads the blob cache.
+    def __init__(self, user, file_id, size):
+        self.file_id = file_id
+        self.size = size
+        self.url = get_file_url(user, file_id)
+        self.cache_key = '%s:%d' % (file_id, size)
+
+    def open(self):
+        file = blobcache.open_blob(self.cache_key)
+        if file is not None:
+            return file
+        if not blobcache.is_cacheable(self.size):
+            return open_file(self.url)
+        lock = db.get_blob_lock(self.cache_key, BLOB_LOCK_EXPIRE)
+        lock.acquire()  # Waits for whoever is downloading it already
+        try:
+            file = blobcache.open_blob(self.cache_key)
+            if file is not None:
+                return file
+            with open_file(self.url) as download:
+                return blobcache.store_blob(self.cache_key, download)
+        finally:
+            lock.release()
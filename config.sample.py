@@ -4,12 +4,72 @@ DEBUG = True
 MODULE_VERSION = ""
 
 GLOBAL_MAX_FILE_SIZE = 64 * 1024 * 1024
-CRON_INTERVAL = 600
+CRON_INTERVAL = 600  # How often a user with recent changes is synced
+
+# The scheduler wakes up every SCHEDULER_TICK seconds and queues the users who are due. Intervals vary by +/- SCHEDULER_JITTER.
+SCHEDULER_TICK = 15
+SCHEDULER_JITTER = 0.2
+SCHEDULER_IDLE_AFTER = 24 * 3600  # The sync interval doubles for every this long without new files...
+SCHEDULER_MAX_INTERVAL = 4 * 3600  # ...up to this
+SCHEDULER_MAX_QUEUE_DEPTH = 500  # Users are not queued while the user and file queues hold more jobs than this
+
+FILE_BATCH_SIZE = 20  # Files of one user transferred by a single job
+# Files of a batch transferred at once by one worker. Each transfer holds about two TRANSFER_CHUNK_SIZE buffers.
+FILE_TRANSFER_CONCURRENCY = 8
+# Batches are handed to the file queue fairly across users by the scheduler. Each round a user may dispatch FILE_QUEUE_QUANTUM bytes,
+# with every file counted as FILE_OVERHEAD_COST bytes more than its size.
+FILE_QUEUE_DEPTH = 32  # Jobs kept in the file queue, should be a bit more than the number of file workers
+FILE_QUEUE_QUANTUM = 16 * 1024 * 1024
+FILE_OVERHEAD_COST = 256 * 1024
+FILE_DISPATCH_INTERVAL = 1
+QUOTA_NOTIFY_INTERVAL = 24 * 3600  # Users are told at most this often that files do not fit in their target
+FILE_STATUS_TIMEOUT = 6 * 3600  # A file handed to the file queue or transferring for longer than this is assumed lost and queued again
+RECONCILE_MAX_ATTEMPTS = 5  # Syncs in a row failing to list the target after logging in again before uploading everything instead
+
+# Files are streamed from IVLE to the target in chunks of this size.
+TRANSFER_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_CHUNK_RETRIES = 3  # A chunk is sent again this many times after a dropped connection before the transfer fails
+UPLOAD_SESSION_TTL = 24 * 3600  # A failed upload bigger than a chunk is resumed where it stopped if retried within this long
+ONEDRIVE_FRAGMENT_SIZE = 10 * 320 * 1024  # Must be a multiple of 320 KB
+GOOGLE_CHUNK_SIZE = 16 * 256 * 1024  # Must be a multiple of 256 KB
+
+# Files downloaded from IVLE are kept here for other users taking the same course, up to BLOB_CACHE_SIZE bytes in total. Leave
+# BLOB_CACHE_DIR empty to download every file for every user. Files bigger than a tenth of the cache are never kept.
+BLOB_CACHE_DIR = ""
+BLOB_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+BLOB_LOCK_EXPIRE = 60
+DROPBOX_COPY_REF_TTL = 7 * 24 * 3600  # Dropbox copy refs last about a month
+
+# A successful check of a user's target settings is trusted for this long before checking with the provider again.
+SETTINGS_VERIFIED_TTL = 1800
+
+# Authorised API clients kept per worker process for each driver, so consecutive files of a user reuse connections. Only reused
+# across jobs when the workers are run as rq.worker.SimpleWorker, see README.md.
+CLIENT_POOL_SIZE = 64
+
+# Requests per second and burst allowed across all workers, for each provider and for each user credential of a provider.
+# A wait longer than RATE_LIMIT_MAX_WAIT puts the file off instead. Throttled requests back off exponentially from BACKOFF_BASE
+# up to BACKOFF_MAX seconds unless the provider says how long with Retry-After.
+RATE_LIMITS = {'dropbox': (50, 100), 'google': (20, 40), 'onedrive': (20, 40), 'ivle': (20, 40)}
+USER_RATE_LIMITS = {'dropbox': (10, 20), 'google': (10, 20), 'onedrive': (5, 10)}
+RATE_LIMIT_MAX_WAIT = 30
+BACKOFF_BASE = 2
+BACKOFF_MAX = 600
+# A credential is only backed off after SERVER_ERROR_LIMIT server errors (5xx) within SERVER_ERROR_WINDOW seconds, and the whole
+# provider after PROVIDER_SERVER_ERROR_LIMIT across all credentials; fewer just fail the request and the file is tried again later.
+SERVER_ERROR_WINDOW = 60
+SERVER_ERROR_LIMIT = 3
+PROVIDER_SERVER_ERROR_LIMIT = 20
 
 FLASK_SECRET_KEY = b''
 
 IVLE_APIKEY = ""
 IVLE_TIMEOUT = 60
+IVLE_CRAWL_CONCURRENCY = 4  # Workbins fetched in parallel for one user
+IVLE_MAX_REQUESTS = 32  # Workbin requests in flight across all workers
+IVLE_FULL_CRAWL_INTERVAL = 6 * 3600  # In between only changes since the last crawl are fetched
+IVLE_WORKBIN_CACHE_TTL = 300  # Workbin listings are shared by everyone taking the course for this long
+IVLE_TOKEN_VALIDATED_TTL = 900  # How long a successful token validation lets a user read cached listings
 
 DROPBOX_APPKEY = ""
 DROPBOX_APPSECRET = ""
@@ -26,6 +86,15 @@ SMTP_PASSWORD = ""
 SMTP_FROM = ""
 SMTP_SERVER = ""
 SMTP_PORT = 465
+# mailer.py sends up to MAIL_BATCH_SIZE queued emails at a time over one connection, closed after MAIL_IDLE_TIMEOUT seconds without mail.
+MAIL_BATCH_SIZE = 50
+MAIL_IDLE_TIMEOUT = 60
+MAIL_MAX_ATTEMPTS = 5
+# Errors for the admins are told apart by exception type and where it was raised and caught. The first of a kind in ERROR_MAIL_WINDOW
+# seconds is mailed at once, the rest are counted and sent every ERROR_DIGEST_INTERVAL with up to ERROR_DIGEST_SAMPLES tracebacks each.
+ERROR_MAIL_WINDOW = 3600
+ERROR_DIGEST_INTERVAL = 3600
+ERROR_DIGEST_SAMPLES = 3
 
 REDIS_HOST = ""
 REDIS_PORT = 6379
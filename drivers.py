@@ -1,21 +1,27 @@
 import dropbox
+import hashlib
 import httplib2
 import json
+import socket
+import threading
+import time
 import urllib
-from io import BytesIO
 from oauth2client import client
 import apiclient
-from api import ivle
-from utils.misc import get_mime_type
-from config import GLOBAL_MAX_FILE_SIZE
+from utils import db, ratelimit
+from utils.misc import get_mime_type, LRUCache
+from config import GLOBAL_MAX_FILE_SIZE, TRANSFER_CHUNK_SIZE, SETTINGS_VERIFIED_TTL, CLIENT_POOL_SIZE, DROPBOX_COPY_REF_TTL, \
+    UPLOAD_SESSION_TTL, UPLOAD_CHUNK_RETRIES, ONEDRIVE_FRAGMENT_SIZE, GOOGLE_CHUNK_SIZE
 
 
 class SyncException(Exception):
     # If retry is False during transferring file we will give up that file and never try again.
     # retry is ignored during user checking - i.e. unless it is never going to success, always set to True.
     # If disable_user is True we will disable the user until he manually re-enable it.
-    def __init__(self, message, retry=True, send_email=False, disable_user=False, logout_user=False):
+    # If retry_after is set the provider is throttling us, and the file is tried again after that many seconds instead of the next sync.
+    def __init__(self, message, retry=True, send_email=False, disable_user=False, logout_user=False, retry_after=None):
         self.retry = retry
+        self.retry_after = retry_after
         self.send_email = send_email
         self.disable_user = disable_user
         self.logout_user = logout_user
@@ -23,8 +29,105 @@ class SyncException(Exception):
         super()
 
 
+# Pooled OAuth2 clients are keyed by refresh token, which survives access token refreshes, so a refreshed client keeps being reused.
+def oauth_credentials_key(credentials_json):
+    try:
+        return json.loads(credentials_json)['refresh_token'] or credentials_json
+    except (KeyError, ValueError):
+        return credentials_json
+
+
+# httplib2.Http is not thread-safe, so the Google Drive and OneDrive clients are pooled per thread as well as per credential. The
+# transfer threads live as long as the worker (see worker.transfer_executor), so their clients are reused from one batch to the next.
+# Dropbox clients are shared, its REST client is backed by a thread-safe urllib3 pool.
+def thread_client_key(credential_key):
+    return threading.get_ident(), credential_key
+
+
+def discard_thread_clients(clients, credential_key):  # Of every thread, once the credential is known to be bad
+    clients.discard_where(lambda key: key[1] == credential_key)
+
+
+def credential_hash(credential_key):
+    return hashlib.sha1(credential_key.encode('utf-8')).hexdigest()[:16]
+
+
+def rate_limited_exception(e):
+    return SyncException(str(e), retry=True, send_email=False, disable_user=False, logout_user=False, retry_after=e.retry_after)
+
+
+# Status codes which mean the provider wants us to slow down: throttling backs off the credential straight away, server errors only
+# once there are too many of them, see ratelimit.server_error.
+THROTTLED_STATUSES = [429]
+OVERLOADED_STATUSES = [500, 502, 503, 504]
+
+
+# Raises RateLimitedException if the response means requests should stop for a while, otherwise returns for the caller to fail the
+# request as usual.
+def throttle_response(names, provider, status, retry_after):
+    if status in THROTTLED_STATUSES:
+        raise ratelimit.RateLimitedException(provider, ratelimit.throttle(names[-1], ratelimit.parse_retry_after(retry_after)))
+    retry_after = ratelimit.server_error(names, ratelimit.parse_retry_after(retry_after))
+    if retry_after is not None:
+        raise ratelimit.RateLimitedException(provider, retry_after)
+
+
+# Used by DropboxClient in place of dropbox.rest.RESTClient, so every API call takes a token from the shared rate limiter first.
+class RateLimitedRESTClient():
+    def __init__(self, credential_key):
+        self.names = ratelimit.bucket_names('dropbox', credential_hash(credential_key))
+
+    def request(self, *args, **kwargs):
+        ratelimit.acquire(self.names)
+        try:
+            response = dropbox.rest.RESTClient.request(*args, **kwargs)
+        except dropbox.rest.ErrorResponse as e:
+            if e.status in THROTTLED_STATUSES + OVERLOADED_STATUSES:
+                headers = {key.lower(): value for key, value in dict(e.headers).items()}
+                throttle_response(self.names, 'dropbox', e.status, headers.get('retry-after'))
+            raise
+        ratelimit.succeeded(self.names)
+        return response
+
+    def GET(self, url, headers=None, raw_response=False):
+        return self.request("GET", url, headers=headers, raw_response=raw_response)
+
+    def POST(self, url, params=None, headers=None, raw_response=False):
+        return self.request("POST", url, post_params=params, headers=headers, raw_response=raw_response)
+
+    def PUT(self, url, body, headers=None, raw_response=False):
+        return self.request("PUT", url, body=body, headers=headers, raw_response=raw_response)
+
+
+# The same for the authorised httplib2.Http objects of Google Drive and OneDrive. Google reports rate limits as 403 with a reason:
+# userRateLimitExceeded for the credential and rateLimitExceeded for the whole project.
+class RateLimitedHttp():
+    def __init__(self, http, provider, credential_key):
+        self.http = http
+        self.provider = provider
+        self.names = ratelimit.bucket_names(provider, credential_hash(credential_key))
+
+    def request(self, *args, **kwargs):
+        ratelimit.acquire(self.names)
+        (resp_headers, content) = self.http.request(*args, **kwargs)
+        status = int(resp_headers['status'])
+        if status == 403 and isinstance(content, bytes) and b'RateLimitExceeded' in content:  # userRateLimitExceeded
+            status = THROTTLED_STATUSES[0]
+        elif status == 403 and isinstance(content, bytes) and b'rateLimitExceeded' in content:
+            raise ratelimit.RateLimitedException(self.provider, ratelimit.throttle(self.names[0]))
+        if status in THROTTLED_STATUSES + OVERLOADED_STATUSES:
+            throttle_response(self.names, self.provider, status, resp_headers.get('retry-after'))
+        else:
+            ratelimit.succeeded(self.names)
+        return resp_headers, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
 class BaseDriver():
     MAX_FILE_SIZE = GLOBAL_MAX_FILE_SIZE
+    SETTINGS_KEYS = ()  # The parts of target_settings check_settings depends on
 
     # Drivers should do error handling here. Throw an Exception to trigger an email being sent to the user.
     # Should NEVER return False, raise an exception if something is wrong!
@@ -32,15 +135,52 @@ class BaseDriver():
     def check_settings(cls, user_settings):
         return True
 
+    # check_settings is a round trip to the provider, so a successful check is remembered for SETTINGS_VERIFIED_TTL.
+    # Pass refresh=True to check again regardless, e.g. at the start of a sync.
+    @classmethod
+    def verify_settings(cls, user_settings, refresh=False):
+        fingerprint = cls.settings_fingerprint(user_settings)
+        if not refresh and db.is_settings_verified(fingerprint):
+            return True
+        result = cls.check_settings(user_settings)
+        if result:
+            db.set_settings_verified(fingerprint, SETTINGS_VERIFIED_TTL)
+        return result
+
+    # Called when the provider rejects the credentials (401 / 403) so that the next file checks them again.
+    @classmethod
+    def forget_verified_settings(cls, user_settings):
+        db.clear_settings_verified(cls.settings_fingerprint(user_settings))
+
+    @classmethod
+    def settings_fingerprint(cls, user_settings):
+        return hashlib.sha1(repr([cls.__name__] + [user_settings.get(key) for key in cls.SETTINGS_KEYS]).encode('utf-8')).hexdigest()
+
+    # source is an ivle.WorkbinFile, open() it to read the file.
     # Error handling here. Return True if transfer succeeded. Return False if a retry is needed.
     # Throw an Exception to trigger an email being sent to the user.
     # But except IVLEUnknownErrorException, which will be handled differently.
     # Should NEVER return False, raise an exception if something is wrong!
-    # Updated 10/04: Due to changes of lock in worker.py, drivers need to take care of locking / updating themselves.
+    # Drivers write what they need to keep (e.g. file revisions) through the user's field-level helpers, no lock is held around transfers.
     @classmethod
-    def transport_file(cls, user, file_url, target_path):
+    def transport_file(cls, user, source, target_path):
         return True
 
+    # Everything already in the target, as {path_key(path): size} for paths like the target_path given to transport_file. Used to
+    # tell which files need no uploading after the user logs in again, so it should take as few calls as possible.
+    @classmethod
+    def list_files(cls, user_settings):
+        return {}
+
+    @classmethod
+    def path_key(cls, path):
+        return path.lower()
+
+    # Bytes left in the target, or None if unknown.
+    @classmethod
+    def get_free_space(cls, user_settings):
+        return None
+
 
 class NullDriver(BaseDriver):
     @classmethod
@@ -48,11 +188,18 @@ class NullDriver(BaseDriver):
         raise SyncException("You have not selected a target service.", retry=True, send_email=True, disable_user=True, logout_user=False)
 
     @classmethod
-    def transport_file(cls, user, file_url, target_path):
+    def transport_file(cls, user, source, target_path):
         raise SyncException("You have not selected a target service.", retry=True, send_email=True, disable_user=True, logout_user=False)
 
 
 class DropboxDriver(BaseDriver):
+    SETTINGS_KEYS = ('token', 'folder')
+    clients = LRUCache(CLIENT_POOL_SIZE)
+
+    @classmethod
+    def get_dropbox_client(cls, token):
+        return cls.clients.get(token, lambda: dropbox.client.DropboxClient(token, rest_client=RateLimitedRESTClient(token)))
+
     @classmethod
     def check_settings(cls, user_settings):
         if not user_settings['token']:
@@ -61,11 +208,14 @@ class DropboxDriver(BaseDriver):
         if not user_settings['folder']:
             raise SyncException("You have not set your target folder.", retry=True, send_email=True, disable_user=True, logout_user=False)
         try:
-            dropbox_client = dropbox.client.DropboxClient(user_settings['token'])
+            dropbox_client = cls.get_dropbox_client(user_settings['token'])
             if dropbox_client.account_info():
                 return True
+        except ratelimit.RateLimitedException as e:
+            raise rate_limited_exception(e)
         except dropbox.rest.ErrorResponse as e:
             if e.status == 401:
+                cls.clients.discard(user_settings['token'])
                 raise SyncException("You are not logged in to Dropbox or your token is expired. Please re-login on the webpage.", retry=True, send_email=True,
                                     disable_user=True, logout_user=True)
             elif e.status in [400, 429, 500, 503]:
@@ -73,29 +223,34 @@ class DropboxDriver(BaseDriver):
             raise e
 
     @classmethod
-    def transport_file(cls, user, file_url, target_path):
-        if not cls.check_settings(user.target_settings):
+    def transport_file(cls, user, source, target_path):
+        if not cls.verify_settings(user.target_settings):
             return  # Should never reach
         try:
-            dropbox_client = dropbox.client.DropboxClient(user.target_settings['token'])
-            file_data = dropbox_client.put_file(user.target_settings['folder'] + target_path, ivle.get_file(file_url),
-                                                parent_rev=user.target_settings['files_revision'].get(target_path, ''))
-
-            with user.lock:
-                user.sync_from_db()
-                user.target_settings['files_revision'][target_path] = file_data['revision']
-                user.update()
+            dropbox_client = cls.get_dropbox_client(user.target_settings['token'])
+            path = user.target_settings['folder'] + target_path
+            parent_rev = user.get_file_revision(target_path)
+            file_data = None
+            if not parent_rev:  # Copy refs cannot overwrite, so only new files are copied
+                file_data = cls.add_shared_copy(dropbox_client, source, path)
+            if file_data is None:
+                with source.open() as file:
+                    file_data = cls.upload_chunked(dropbox_client, user.user_id, source, file, path, parent_rev)
+                cls.share_copy(dropbox_client, source, file_data['path'])
+            user.set_file_revision(target_path, file_data['revision'])
             return True
+        except ratelimit.RateLimitedException as e:
+            raise rate_limited_exception(e)
         except dropbox.rest.ErrorResponse as e:
+            if e.status in [401, 403]:
+                cls.forget_verified_settings(user.target_settings)
             if e.status == 401:
+                cls.clients.discard(user.target_settings['token'])
                 raise SyncException("You are not logged in to Dropbox or your token is expired. Please re-login on the webpage.", retry=True, send_email=True,
                                     disable_user=True, logout_user=True)
             elif e.status in [400, 429, 500, 503]:
                 if e.status == 400 and (("'parent_rev' is not well-formed" in e.error_msg) or ("Invalid parent_rev" in e.error_msg)):
-                    with user.lock:
-                        user.sync_from_db()
-                        user.target_settings['files_revision'][target_path] = ''
-                        user.update()
+                    user.set_file_revision(target_path, '')
                 raise SyncException(e.error_msg, retry=True, send_email=False, disable_user=False, logout_user=False)
             elif e.status == 507:
                 raise SyncException(
@@ -103,8 +258,154 @@ class DropboxDriver(BaseDriver):
                     retry=True, send_email=True, disable_user=True, logout_user=False)
             raise e
 
+    @classmethod
+    def get_free_space(cls, user_settings):
+        quota_info = cls.get_dropbox_client(user_settings['token']).account_info()['quota_info']
+        return quota_info['quota'] - quota_info['normal'] - quota_info['shared']
+
+    # One delta listing of the target folder, a page of up to a couple of thousand entries per call.
+    @classmethod
+    def list_files(cls, user_settings):
+        dropbox_client = cls.get_dropbox_client(user_settings['token'])
+        folder = user_settings['folder'].rstrip('/').lower()  # Delta paths are lower case
+        files = {}
+        cursor = None
+        while True:
+            delta = dropbox_client.delta(cursor, path_prefix=folder or None)
+            for path, metadata in delta['entries']:
+                if metadata and not metadata.get('is_dir') and path.startswith(folder + '/'):
+                    files[path[len(folder):]] = metadata['bytes']
+            cursor = delta['cursor']
+            if not delta['has_more']:
+                return files
+
+    # Once a file has been uploaded to someone's Dropbox, everyone else gets it by a server-side copy from there through a copy ref.
+    # Returns None if there is no usable copy ref, in which case the file is uploaded as usual. The original may have been changed
+    # by its owner since, so a copy which is not the size of the IVLE file is deleted again and the copy ref forgotten.
+    @classmethod
+    def add_shared_copy(cls, dropbox_client, source, path):
+        copy_ref = db.get_dropbox_copy_ref(source.cache_key)
+        if not copy_ref:
+            return None
+        try:
+            file_data = dropbox_client.add_copy_ref(copy_ref, path)
+        except dropbox.rest.ErrorResponse as e:
+            if e.status in [400, 404]:  # The original is gone
+                db.clear_dropbox_copy_ref(source.cache_key)
+            return None
+        if source.size is None or file_data.get('bytes') == source.size:
+            return file_data
+        db.clear_dropbox_copy_ref(source.cache_key)
+        dropbox_client.file_delete(file_data['path'])
+        return None
+
+    @classmethod
+    def share_copy(cls, dropbox_client, source, path):
+        if db.get_dropbox_copy_ref(source.cache_key):
+            return
+        try:
+            db.set_dropbox_copy_ref(source.cache_key, dropbox_client.create_copy_ref(path)['copy_ref'], DROPBOX_COPY_REF_TTL)
+        except dropbox.rest.ErrorResponse:
+            pass  # Only an optimisation
+
+    # Files bigger than a chunk remember their upload session after every chunk, so that a transfer which fails half way carries on
+    # from the last chunk Dropbox acknowledged next time instead of from the start. Dropbox keeps sessions for 48 hours.
+    @classmethod
+    def upload_chunked(cls, dropbox_client, user_id, source, file, path, parent_rev):
+        session = db.get_upload_session(user_id, source.cache_key)
+        if session and session['target'] == ('dropbox', path):
+            upload_id, offset = session['upload_id'], session['offset']
+            file.skip(offset)
+        else:
+            session = None
+            upload_id, offset = None, 0
+        try:
+            for chunk in file:
+                offset, upload_id = cls.upload_chunk(dropbox_client, chunk, offset, upload_id)
+                if source.size > TRANSFER_CHUNK_SIZE:
+                    session = {'target': ('dropbox', path), 'upload_id': upload_id, 'offset': offset}
+                    db.set_upload_session(user_id, source.cache_key, session, UPLOAD_SESSION_TTL)
+        except dropbox.rest.ErrorResponse as e:
+            if e.status == 404 and session:  # The session has expired
+                db.clear_upload_session(user_id, source.cache_key)
+                raise SyncException("Dropbox upload session expired, will start over.", retry=True, send_email=False, disable_user=False,
+                                    logout_user=False)
+            raise
+        if upload_id is None:  # Empty file, chunked_upload does not accept that
+            return dropbox_client.put_file(path, b'', parent_rev=parent_rev)
+        file_data = dropbox_client.commit_chunked_upload(dropbox_client.session.root + dropbox.client.format_path(path), upload_id,
+                                                         parent_rev=parent_rev)
+        if session:
+            db.clear_upload_session(user_id, source.cache_key)
+        return file_data
+
+    # Sends chunk, which starts at offset. After a dropped connection it is sent again, and if Dropbox got part or all of it
+    # already (it tells us its offset with a 400), only the rest is sent. Returns the new offset and upload ID.
+    @classmethod
+    def upload_chunk(cls, dropbox_client, chunk, offset, upload_id):
+        start, end = offset, offset + len(chunk)
+        failures = 0
+        while offset < end:
+            try:
+                offset, upload_id = dropbox_client.upload_chunk(chunk[offset - start:], end - offset, offset, upload_id)
+            except dropbox.rest.ErrorResponse as e:
+                server_offset = e.body.get('offset') if e.status == 400 and isinstance(e.body, dict) else None
+                failures += 1
+                if server_offset is None or not start <= server_offset <= end or failures > UPLOAD_CHUNK_RETRIES:
+                    raise
+                offset, upload_id = server_offset, e.body.get('upload_id', upload_id)
+            except dropbox.rest.RESTSocketError:
+                failures += 1
+                if failures > UPLOAD_CHUNK_RETRIES:
+                    raise
+                time.sleep(2 ** failures)
+        return offset, upload_id
+
+
+class StreamMediaUpload(apiclient.http.MediaUpload):
+    # MediaIoBaseUpload needs a seekable file, so it cannot take an IVLE download without buffering the whole file.
+    # next_chunk() always asks for the bytes right after the last acknowledged ones, so keeping the last chunk is enough.
+    def __init__(self, file, mimetype, chunksize=GOOGLE_CHUNK_SIZE):
+        super().__init__()
+        self._file = file
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer_begin = 0
+        self._buffer = b''
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._file.size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_begin:
+            raise ValueError("Cannot rewind to %d, earliest available byte is %d." % (begin, self._buffer_begin))
+        buffer_end = self._buffer_begin + len(self._buffer)
+        if begin > buffer_end:  # Resuming a session which already has these bytes
+            self._file.skip(begin - buffer_end)
+            self._buffer_begin, self._buffer = begin, b''
+        data = self._buffer[begin - self._buffer_begin:begin - self._buffer_begin + length]
+        data += self._file.read(length - len(data))
+        self._buffer_begin, self._buffer = begin, data
+        return data
+
 
 class GoogleDriver(BaseDriver):
+    SETTINGS_KEYS = ('credentials', 'parent_id')
+    clients = LRUCache(CLIENT_POOL_SIZE)
+    discovery_document = None
+
     @classmethod
     def check_settings(cls, user_settings):
         if not user_settings['credentials']:
@@ -116,7 +417,10 @@ class GoogleDriver(BaseDriver):
             service = cls.get_drive_client(user_settings)
             if cls.get_folder_name(service, user_settings['parent_id']):
                 return True
+        except ratelimit.RateLimitedException as e:
+            raise rate_limited_exception(e)
         except client.AccessTokenRefreshError as e:
+            discard_thread_clients(cls.clients, oauth_credentials_key(user_settings['credentials']))
             raise SyncException("You are not logged in to Google Drive or your token is expired. Please re-login on the webpage.", retry=True, send_email=True,
                                 disable_user=True, logout_user=True)
         except apiclient.errors.HttpError as e:
@@ -126,60 +430,151 @@ class GoogleDriver(BaseDriver):
                                 retry=True, send_email=True, disable_user=True, logout_user=False)
 
     @classmethod
-    def transport_file(cls, user, file_url, target_path):
-        if not cls.check_settings(user.target_settings):
+    def transport_file(cls, user, source, target_path):
+        if not cls.verify_settings(user.target_settings):
             return  # Should never reach
         try:
             service = cls.get_drive_client(user.target_settings)
-            path_id = cls.find_path(service, user.target_settings['parent_id'], target_path.split('/')[1:-1])
-            media_body = apiclient.http.MediaIoBaseUpload(BytesIO(ivle.get_file(file_url)), mimetype=get_mime_type(target_path), resumable=True)
+            path_id = cls.find_path(service, user.user_id, user.target_settings['parent_id'], target_path.split('/')[1:-1])
             body = {'title': target_path[target_path.rfind('/') + 1:], 'parents': [{'id': path_id}]}
-            file = service.files().insert(body=body, media_body=media_body).execute()
-            return bool(file['id'])
+            with source.open() as file:
+                request = service.files().insert(body=body, media_body=StreamMediaUpload(file, get_mime_type(target_path), GOOGLE_CHUNK_SIZE))
+                response = cls.upload_resumable(request, user.user_id, source, ('google', path_id, body['title']))
+            return bool(response['id'])
+        except ratelimit.RateLimitedException as e:
+            raise rate_limited_exception(e)
         except client.AccessTokenRefreshError as e:
+            cls.forget_verified_settings(user.target_settings)
+            discard_thread_clients(cls.clients, oauth_credentials_key(user.target_settings['credentials']))
             raise SyncException("You are not logged in to Google Drive or your token is expired. Please re-login on the webpage.", retry=True, send_email=True,
                                 disable_user=True, logout_user=True)
-        except apiclient.errors.ResumableUploadError as e:
-            raise SyncException("ResumableUploadError, will retry.", retry=True, send_email=False, disable_user=False, logout_user=False)
-        except apiclient.errors.HttpError as e:
+        except apiclient.errors.HttpError as e:  # Including ResumableUploadError
+            if e.resp.status in [404, 410]:
+                db.clear_google_folders(user.user_id)  # One of the cached folders is gone, or the upload session has expired
+                db.clear_upload_session(user.user_id, source.cache_key)
+            elif e.resp.status in [401, 403]:
+                cls.forget_verified_settings(user.target_settings)
+            if isinstance(e, apiclient.errors.ResumableUploadError):
+                raise SyncException("ResumableUploadError, will retry.", retry=True, send_email=False, disable_user=False, logout_user=False)
             raise SyncException(str(e), retry=True, send_email=False, disable_user=False, logout_user=False)
         except Exception as e:
             raise SyncException("Something might go wrong with your Google Drive settings. If you are not able to find the error, please inform the developer.",
                                 retry=True, send_email=True, disable_user=True, logout_user=False)
 
+    # The resumable session URI is remembered after every chunk of a file bigger than one, so a later attempt continues the same
+    # session: next_chunk() in error state first asks Google how much it has. Dropped connections are retried the same way.
     @classmethod
-    def find_path(cls, service, base_path_id, path):
-        if not path:
-            return base_path_id
-        page_token = None
-        while True:
-            param = {}
-            if page_token:
-                param['pageToken'] = page_token
-            children = service.children().list(folderId=base_path_id, **param).execute()
-            for child in children.get('items', []):
-                file = service.files().get(fileId=child['id']).execute()
-                if file['mimeType'] == "application/vnd.google-apps.folder" and file['title'] == path[0]:
-                    return cls.find_path(service, child['id'], path[1:])
-            page_token = children.get('nextPageToken')
-            if not page_token:
-                body = {
-                    'title': path[0],
-                    "parents": [{"id": base_path_id}],
-                    "mimeType": "application/vnd.google-apps.folder",
-                }
-                file = service.files().insert(body=body).execute()
-                return cls.find_path(service, file['id'], path[1:])
+    def upload_resumable(cls, request, user_id, source, target):
+        session = db.get_upload_session(user_id, source.cache_key)
+        if session and session['target'] == target:
+            request.resumable_uri = session['uri']
+            request._in_error_state = True
+        response = None
+        failures = 0
+        while response is None:
+            try:
+                status, response = request.next_chunk()
+            except (httplib2.HttpLib2Error, ConnectionError, socket.timeout):
+                failures += 1
+                if failures > UPLOAD_CHUNK_RETRIES:
+                    raise
+                time.sleep(2 ** failures)
+                continue
+            if response is None and source.size > GOOGLE_CHUNK_SIZE:
+                session = {'target': target, 'uri': request.resumable_uri, 'offset': request.resumable_progress}
+                db.set_upload_session(user_id, source.cache_key, session, UPLOAD_SESSION_TTL)
+        if session:
+            db.clear_upload_session(user_id, source.cache_key)
+        return response
+
+    @classmethod
+    def get_free_space(cls, user_settings):
+        about = cls.get_drive_client(user_settings).about().get(fields='quotaType,quotaBytesTotal,quotaBytesUsedAggregate').execute()
+        if about.get('quotaType') != 'LIMITED':  # quotaBytesTotal means nothing for unlimited (education) accounts
+            return None
+        return int(about['quotaBytesTotal']) - int(about['quotaBytesUsedAggregate'])
 
+    # One listing per folder below the target folder.
+    @classmethod
+    def list_files(cls, user_settings):
+        service = cls.get_drive_client(user_settings)
+        files = {}
+        folders = [(user_settings['parent_id'], '')]
+        while folders:
+            folder_id, folder_path = folders.pop()
+            params = {'q': "'%s' in parents and trashed = false" % folder_id, 'maxResults': 1000,
+                      'fields': 'nextPageToken,items(id,title,mimeType,fileSize)'}
+            while True:
+                result = service.files().list(**params).execute()
+                for item in result.get('items', []):
+                    path = folder_path + '/' + item['title']
+                    if item['mimeType'] == 'application/vnd.google-apps.folder':
+                        folders.append((item['id'], path))
+                    elif 'fileSize' in item:
+                        files[cls.path_key(path)] = int(item['fileSize'])
+                if not result.get('nextPageToken'):
+                    break
+                params['pageToken'] = result['nextPageToken']
+        return files
+
+    # Folder IDs are cached per user, keyed by the target folder ID and the path below it, so uploading into a folder
+    # we have seen before costs no API call. Entries are not checked before use; a 404 on upload drops the whole cache.
+    @classmethod
+    def find_path(cls, service, user_id, base_path_id, path):
+        cached_ids = db.get_google_folders(user_id, ['/'.join([base_path_id] + path[:depth]) for depth in range(1, len(path) + 1)])
+        folder_id, depth = base_path_id, 0
+        for i in reversed(range(len(path))):
+            if cached_ids[i]:
+                folder_id, depth = cached_ids[i].decode('utf-8'), i + 1
+                break
+        for i in range(depth, len(path)):
+            folder_id = cls.find_or_create_folder(service, user_id, folder_id, path[i])
+            db.set_google_folder(user_id, '/'.join([base_path_id] + path[:i + 1]), folder_id)
+        return folder_id
+
+    @classmethod
+    def find_folder(cls, service, parent_id, title):
+        query = "'%s' in parents and title = '%s' and mimeType = 'application/vnd.google-apps.folder' and trashed = false" % (
+            parent_id, title.replace('\\', '\\\\').replace("'", "\\'"))
+        folders = service.files().list(q=query, maxResults=1, fields='items(id)').execute().get('items', [])
+        return folders[0]['id'] if folders else None
+
+    # Drive allows several folders with the same title, so the transfers of a user looking for the same missing folder at once take
+    # turns creating it, and look again once they have the lock.
+    @classmethod
+    def find_or_create_folder(cls, service, user_id, parent_id, title):
+        folder_id = cls.find_folder(service, parent_id, title)
+        if folder_id:
+            return folder_id
+        with db.get_google_folder_lock(user_id, parent_id, title):
+            folder_id = cls.find_folder(service, parent_id, title)
+            if folder_id:
+                return folder_id
+            body = {
+                'title': title,
+                "parents": [{"id": parent_id}],
+                "mimeType": "application/vnd.google-apps.folder",
+            }
+            return service.files().insert(body=body, fields='id').execute()['id']
 
     @classmethod
     def get_drive_client(cls, user_settings):
         if not user_settings['credentials']:
             raise SyncException("You are not logged in to Google Drive or your token is expired. Please re-login on the webpage.", retry=True, send_email=True,
                                 disable_user=True, logout_user=True)
-        credentials = client.OAuth2Credentials.from_json(user_settings['credentials'])
-        http_auth = credentials.authorize(httplib2.Http())
-        return apiclient.discovery.build('drive', 'v2', http=http_auth)
+        return cls.clients.get(thread_client_key(oauth_credentials_key(user_settings['credentials'])),
+                               lambda: cls.build_drive_client(user_settings['credentials']))
+
+    @classmethod
+    def build_drive_client(cls, credentials_json):
+        if cls.discovery_document is None:  # Fetched once per process instead of once per client
+            (resp_headers, content) = httplib2.Http().request(apiclient.discovery.DISCOVERY_URI.format(api='drive', apiVersion='v2'))
+            if resp_headers.status != 200:
+                raise apiclient.errors.HttpError(resp_headers, content)
+            cls.discovery_document = content.decode('utf-8')
+        http_auth = client.OAuth2Credentials.from_json(credentials_json).authorize(httplib2.Http())
+        http_auth = RateLimitedHttp(http_auth, 'google', oauth_credentials_key(credentials_json))
+        return apiclient.discovery.build_from_document(cls.discovery_document, http=http_auth)
 
     @classmethod
     def get_folder_name(cls, service, folder_id):
@@ -188,6 +583,25 @@ class GoogleDriver(BaseDriver):
 
 
 class OneDriveDriver(BaseDriver):
+    SETTINGS_KEYS = ('credentials',)
+    clients = LRUCache(CLIENT_POOL_SIZE)
+    upload_http = threading.local()
+
+    # The authorised Http object keeps its connections alive, so reusing it skips the TLS handshake.
+    @classmethod
+    def get_http_auth(cls, user_settings):
+        credential_key = oauth_credentials_key(user_settings['credentials'])
+        return cls.clients.get(thread_client_key(credential_key), lambda: RateLimitedHttp(
+            client.OAuth2Credentials.from_json(user_settings['credentials']).authorize(httplib2.Http()), 'onedrive', credential_key))
+
+    # Upload session URLs are pre-authenticated, and OneDrive may answer 401 if the bearer token is sent along. Fragments and session
+    # status go through a plain Http instead, one per thread, still counted against the credential's rate limit.
+    @classmethod
+    def get_upload_http(cls, user_settings):
+        if not hasattr(cls.upload_http, 'http'):
+            cls.upload_http.http = httplib2.Http()
+        return RateLimitedHttp(cls.upload_http.http, 'onedrive', oauth_credentials_key(user_settings['credentials']))
+
     @classmethod
     def check_settings(cls, user_settings):
         if not user_settings['credentials']:
@@ -195,8 +609,7 @@ class OneDriveDriver(BaseDriver):
                                 disable_user=True, logout_user=True)
         try:
             content = ''
-            credentials = client.OAuth2Credentials.from_json(user_settings['credentials'])
-            http_auth = credentials.authorize(httplib2.Http())
+            http_auth = cls.get_http_auth(user_settings)
             (resp_headers, content) = http_auth.request("https://api.onedrive.com/v1.0/drive/special/approot", method="GET")
             if resp_headers['status'] in [str(i) for i in [429, 500, 501, 503]]:
                 raise SyncException("HTTP Error: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
@@ -208,12 +621,15 @@ class OneDriveDriver(BaseDriver):
                     retry=True, send_email=True, disable_user=True, logout_user=False)
             return bool(json.loads(content.decode('ascii'))['id'])
         except client.AccessTokenRefreshError as e:
+            discard_thread_clients(cls.clients, oauth_credentials_key(user_settings['credentials']))
             raise SyncException("You are not logged in to OneDrive or your token is expired. Please re-login on the webpage.", retry=True, send_email=True,
                                 disable_user=True, logout_user=True)
         except ConnectionResetError as e:
             raise SyncException("Connection to OneDrive is interrupted. Please try again.", retry=True, send_email=False, disable_user=False, logout_user=False)
         except (KeyError, ValueError) as e:
             raise SyncException("OneDrive is not behaving as expected. Please try again.", retry=True, send_email=False, disable_user=False, logout_user=False)
+        except ratelimit.RateLimitedException as e:
+            raise rate_limited_exception(e)
         except SyncException as e:
             raise
         except Exception as e:
@@ -221,42 +637,36 @@ class OneDriveDriver(BaseDriver):
                                 retry=True, send_email=True, disable_user=True, logout_user=False)
 
     @classmethod
-    def transport_file(cls, user, file_url, target_path):
-        if not cls.check_settings(user.target_settings):
+    def transport_file(cls, user, source, target_path):
+        if not cls.verify_settings(user.target_settings):
             return  # Should never reach
         try:
             content = ''
-            credentials = client.OAuth2Credentials.from_json(user.target_settings['credentials'])
-            http_auth = credentials.authorize(httplib2.Http())
+            http_auth = cls.get_http_auth(user.target_settings)
             target_path = target_path.replace('\t', '_')  # TODO: Temp workaround for OD bug on \t
             target_path = target_path.replace(':', '_')  # TODO: Temp workaround for OD bug on :
-            cls.create_path(http_auth, target_path.split('/')[1:-1])
-            (resp_headers, content) = http_auth.request("https://api.onedrive.com/v1.0/drive/special/approot:%s:/content" % urllib.parse.quote(target_path),
-                                                        method="PUT", body=ivle.get_file(file_url), headers={'content-type': get_mime_type(target_path)})
-            if resp_headers['status'] in [str(i) for i in [429, 500, 501, 503]]:
-                raise SyncException("HTTP Error: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
-            elif resp_headers['status'] == '400':
-                raise SyncException("400: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
-            elif resp_headers['status'] == '507':
-                raise SyncException(
-                    "OneDrive says you are over quota. We have temporarily disabled syncing for you. Please manually re-enable after cleaning up some files.",
-                    retry=True, send_email=True, disable_user=True, logout_user=False)
-            file_id = json.loads(content.decode('ascii'))['id']
-            (resp_headers, content) = http_auth.request("https://api.onedrive.com/v1.0/drive/items/%s" % file_id, method="PATCH",
-                                                        body=json.dumps({'name': target_path[target_path.rfind('/') + 1:]}),
-                                                        headers={'content-type': 'application/json'})
-            if resp_headers['status'] in [str(i) for i in [429, 500, 501, 503]]:
-                raise SyncException("HTTP Error: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
-            elif resp_headers['status'] == '400':
-                raise SyncException("400: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
-            return bool(json.loads(content.decode('ascii'))['id'])
+            cls.create_path(http_auth, user.user_id, target_path.split('/')[1:-1])
+            with source.open() as file:
+                if file.size == 0:  # Upload sessions cannot take an empty file
+                    (resp_headers, content) = http_auth.request(
+                        "https://api.onedrive.com/v1.0/drive/special/approot:%s:/content" % urllib.parse.quote(target_path), method="PUT", body=b'',
+                        headers={'content-type': get_mime_type(target_path), 'content-length': '0'})
+                    cls.check_response(user, resp_headers)
+                    item = json.loads(content.decode('utf-8'))
+                else:
+                    item = cls.upload_session(http_auth, user, source, file, target_path)
+            return bool(item['id'])
         except client.AccessTokenRefreshError as e:
+            cls.forget_verified_settings(user.target_settings)
+            discard_thread_clients(cls.clients, oauth_credentials_key(user.target_settings['credentials']))
             raise SyncException("You are not logged in to OneDrive or your token is expired. Please re-login on the webpage.", retry=True, send_email=True,
                                 disable_user=True, logout_user=True)
-        except ConnectionResetError as e:
+        except ConnectionError as e:  # Including resets, the upload session is resumed next time
             raise SyncException("Connection reset. Ignoring.", retry=True, send_email=False, disable_user=False, logout_user=False)
         except (KeyError, ValueError) as e:
             raise SyncException("Cannot find. Ignoring. Info: %s" % content, retry=True, send_email=False, disable_user=False, logout_user=False)
+        except ratelimit.RateLimitedException as e:
+            raise rate_limited_exception(e)
         except SyncException as e:
             raise
         except Exception as e:
@@ -264,15 +674,156 @@ class OneDriveDriver(BaseDriver):
                                 retry=True, send_email=True, disable_user=True, logout_user=False)
 
     @classmethod
-    def create_path(cls, http_auth, path):
-        if len(path) == 1:
-            (resp_headers, content) = http_auth.request("https://api.onedrive.com/v1.0/drive/special/approot/children", method="POST",
-                                                        body=json.dumps({"name": path[0], "folder": {}}), headers={'content-type': 'application/json'})
-        else:
-            cls.create_path(http_auth, path[:-1])
-            (resp_headers, content) = http_auth.request("https://api.onedrive.com/v1.0/drive/special/approot:/%s:/children" % urllib.parse.quote('/'.join(path[:-1])),
-                                                        method="POST", body=json.dumps({"name": path[-1], "folder": {}}),
+    def check_response(cls, user, resp_headers):
+        if resp_headers['status'] in [str(i) for i in [429, 500, 501, 503]]:
+            raise SyncException("HTTP Error: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
+        elif resp_headers['status'] == '400':
+            raise SyncException("400: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
+        elif resp_headers['status'] in ['401', '403']:
+            cls.forget_verified_settings(user.target_settings)
+            raise SyncException("%s: %s" % (resp_headers['status'], str(resp_headers)), retry=True, send_email=False, disable_user=False,
+                                logout_user=False)
+        elif resp_headers['status'] == '507':
+            raise SyncException(
+                "OneDrive says you are over quota. We have temporarily disabled syncing for you. Please manually re-enable after cleaning up some files.",
+                retry=True, send_email=True, disable_user=True, logout_user=False)
+        elif resp_headers['status'] not in ['200', '201', '202']:
+            raise SyncException("HTTP Error: %s" % str(resp_headers), retry=True, send_email=False, disable_user=False, logout_user=False)
+
+    # Files are sent through an upload session in ONEDRIVE_FRAGMENT_SIZE pieces. The session URL is remembered with the offset
+    # OneDrive expects next, so a later attempt asks OneDrive where it got to and carries on from there. The name is given when the
+    # session is created. Returns the uploaded item.
+    @classmethod
+    def upload_session(cls, http_auth, user, source, file, target_path):
+        data = None
+        size = file.size
+        if size is None:  # Every fragment has to state the total size
+            data = file.read()
+            size = len(data)
+        upload_url, offset = None, 0
+        upload_http = cls.get_upload_http(user.target_settings)
+        session = db.get_upload_session(user.user_id, source.cache_key)
+        if session and session['target'] == ('onedrive', target_path):
+            offset = cls.get_upload_offset(upload_http, session['upload_url'])
+            if offset is not None:
+                upload_url = session['upload_url']
+        if upload_url is None:
+            offset = 0
+            (resp_headers, content) = http_auth.request(
+                "https://api.onedrive.com/v1.0/drive/special/approot:%s:/upload.createSession" % urllib.parse.quote(target_path), method="POST",
+                body=json.dumps({'item': {'@name.conflictBehavior': 'replace', 'name': target_path[target_path.rfind('/') + 1:]}}),
+                headers={'content-type': 'application/json'})
+            cls.check_response(user, resp_headers)
+            upload_url = json.loads(content.decode('utf-8'))['uploadUrl']
+        if data is None:
+            file.skip(offset)
+        position = offset
+        while True:
+            fragment = data[position:position + ONEDRIVE_FRAGMENT_SIZE] if data is not None else file.read(ONEDRIVE_FRAGMENT_SIZE)
+            if not fragment:
+                raise SyncException("OneDrive is still expecting bytes from %d of %d." % (offset, size), retry=True, send_email=False, disable_user=False,
+                                    logout_user=False)
+            offset, item = cls.upload_fragment(upload_http, user, upload_url, fragment, position, size)
+            position += len(fragment)
+            if item is not None:
+                db.clear_upload_session(user.user_id, source.cache_key)
+                return item
+            if offset != position:  # We cannot rewind the download, start again from the session next time
+                raise SyncException("OneDrive expects bytes from %d, we are at %d." % (offset, position), retry=True, send_email=False,
+                                    disable_user=False, logout_user=False)
+            db.set_upload_session(user.user_id, source.cache_key, {'target': ('onedrive', target_path), 'upload_url': upload_url},
+                                  UPLOAD_SESSION_TTL)
+
+    # Sends fragment, which starts at offset. After a dropped connection OneDrive is asked which bytes it has, and only the rest is
+    # sent again. Returns the offset OneDrive expects next and, once the whole file is in, the uploaded item.
+    @classmethod
+    def upload_fragment(cls, http, user, upload_url, fragment, offset, size):
+        start, end = offset, offset + len(fragment)
+        failures = 0
+        while offset < end:
+            try:
+                (resp_headers, content) = http.request(upload_url, method="PUT", body=fragment[offset - start:], headers={
+                    'content-length': str(end - offset), 'content-range': 'bytes %d-%d/%d' % (offset, end - 1, size)})
+            except ConnectionError:
+                failures += 1
+                if failures > UPLOAD_CHUNK_RETRIES:
+                    raise
+                time.sleep(2 ** failures)
+                offset = cls.get_upload_offset(http, upload_url)
+                if offset is None or not start <= offset <= end:
+                    raise
+                continue
+            cls.check_response(user, resp_headers)
+            if resp_headers['status'] in ['200', '201']:
+                return end, json.loads(content.decode('utf-8'))
+            offset = cls.parse_next_offset(json.loads(content.decode('utf-8')))
+            if not start <= offset:
+                break
+        return offset, None
+
+    # Where OneDrive expects the session to carry on, or None if the session is gone.
+    @classmethod
+    def get_upload_offset(cls, http, upload_url):
+        (resp_headers, content) = http.request(upload_url, method="GET")
+        if resp_headers['status'] != '200':
+            return None
+        return cls.parse_next_offset(json.loads(content.decode('utf-8')))
+
+    @classmethod
+    def parse_next_offset(cls, session):
+        return int(session['nextExpectedRanges'][0].split('-')[0])
+
+    @classmethod
+    def get_free_space(cls, user_settings):
+        (resp_headers, content) = cls.get_http_auth(user_settings).request("https://api.onedrive.com/v1.0/drive", method="GET")
+        if resp_headers['status'] != '200':
+            return None
+        return json.loads(content.decode('utf-8'))['quota']['remaining']
+
+    # One listing per folder below the app folder.
+    @classmethod
+    def list_files(cls, user_settings):
+        http_auth = cls.get_http_auth(user_settings)
+        files = {}
+        folders = [("https://api.onedrive.com/v1.0/drive/special/approot/children", '')]
+        while folders:
+            url, folder_path = folders.pop()
+            while url:
+                (resp_headers, content) = http_auth.request(url, method="GET")
+                if resp_headers['status'] != '200':
+                    raise SyncException("Cannot list %s: %s" % (folder_path or '/', str(resp_headers)), retry=True, send_email=False, disable_user=False,
+                                        logout_user=False)
+                result = json.loads(content.decode('utf-8'))
+                for item in result['value']:
+                    path = folder_path + '/' + item['name']
+                    if 'folder' in item:
+                        folders.append(("https://api.onedrive.com/v1.0/drive/items/%s/children" % item['id'], path))
+                    else:
+                        files[cls.path_key(path)] = item['size']
+                url = result.get('@odata.nextLink')
+        return files
+
+    @classmethod
+    def path_key(cls, path):  # Same replacements as transport_file
+        return path.replace('\t', '_').replace(':', '_').lower()
+
+    # Folders known to exist are remembered per user, so only the first file into a new folder pays for creating it.
+    @classmethod
+    def create_path(cls, http_auth, user_id, path):
+        folders = ['/'.join(path[:depth]) for depth in range(1, len(path) + 1)]
+        known = db.are_onedrive_folders_known(user_id, folders)
+        start = max([depth + 1 for depth in range(len(path)) if known[depth]] or [0])
+        for depth in range(start, len(path)):
+            if depth == 0:
+                url = "https://api.onedrive.com/v1.0/drive/special/approot/children"
+            else:
+                url = "https://api.onedrive.com/v1.0/drive/special/approot:/%s:/children" % urllib.parse.quote(folders[depth - 1])
+            (resp_headers, content) = http_auth.request(url, method="POST", body=json.dumps({"name": path[depth], "folder": {}, "@name.conflictBehavior": "fail"}),
                                                         headers={'content-type': 'application/json'})
+            if resp_headers['status'] not in ['200', '201', '409']:  # 409 means it is already there
+                raise SyncException("Cannot create folder %s: %s" % (folders[depth], str(resp_headers)), retry=True, send_email=False, disable_user=False,
+                                    logout_user=False)
+            db.add_onedrive_folder(user_id, folders[depth])
 
 
 drivers = {'dropbox': DropboxDriver, 'google': GoogleDriver, 'onedrive': OneDriveDriver, '': NullDriver, None: NullDriver}
@@ -32,6 +32,7 @@ def dashboard():
     if 'user_id' not in session or session['user_id'] == '':
         return redirect(url_for('login'))
     user = models.User(session['user_id'])
+    user.load('modules', 'target', 'target_settings', 'key', 'enabled', 'uploadable_folder', 'email')
     selected_modules = ', '.join(sorted([course['Code'] for course in user.modules])) or 'None'
     return render_template('dashboard.html', selected_modules=selected_modules, target=user.target, target_settings=user.target_settings,
                            DROPBOX_APPKEY=config.DROPBOX_APPKEY, user_id=user.user_id, key=user.key, sync_enabled=user.enabled,
@@ -61,10 +62,7 @@ def modules_submit():
     for course in request.form:
         course_code, course_id = str(course).split('|')
         courses.append({'Code': course_code, 'ID': course_id})
-    with user.lock:
-        user.sync_from_db()
-        user.modules = courses
-        user.update()
+    user.set_fields(modules=courses)
     return ""
 
 
@@ -82,25 +80,23 @@ def settings_submit():
     if 'user_id' not in session or session['user_id'] == '':
         return redirect(url_for('login'))
     user = models.User(session['user_id'])
-    with user.lock:
-        user.sync_from_db()
-        try:
-            user.enabled = bool(request.form.get('sync_enabled', ''))
-            if (not user.enabled) or (drivers.drivers[user.target].check_settings(user.target_settings)):
-                user.uploadable_folder = bool(request.form.get('uploadable_folder', ''))
-                user.email = request.form.get('email', user.email)
-                user.update()
-                return json.dumps({'result': True})
-            else:  # TODO: Should never reach
-                user.enabled = False
-                user.update()
-                return json.dumps({'result': False, 'message': 'An unknown error happened. Please refresh the page and try again.'})
-        except drivers.SyncException as e:
-            user.enabled = False
+    try:
+        user.enabled = bool(request.form.get('sync_enabled', ''))
+        if (not user.enabled) or (drivers.drivers[user.target].verify_settings(user.target_settings, refresh=True)):
             user.uploadable_folder = bool(request.form.get('uploadable_folder', ''))
             user.email = request.form.get('email', user.email)
             user.update()
-            return json.dumps({'result': False, 'message': e.message})
+            return json.dumps({'result': True})
+        else:  # TODO: Should never reach
+            user.enabled = False
+            user.update()
+            return json.dumps({'result': False, 'message': 'An unknown error happened. Please refresh the page and try again.'})
+    except drivers.SyncException as e:
+        user.enabled = False
+        user.uploadable_folder = bool(request.form.get('uploadable_folder', ''))
+        user.email = request.form.get('email', user.email)
+        user.update()
+        return json.dumps({'result': False, 'message': e.message})
 
 
 # Target: Dropbox
@@ -140,17 +136,19 @@ def auth_dropbox_callback():
     except dropbox.client.DropboxOAuth2Flow.ProviderException as e:
         app.logger.exception("Auth error" + str(e))
         abort(403)
-    with user.lock:
-        user.sync_from_db()
-        user.target = 'dropbox'
-        dropbox_username = dropbox.client.DropboxClient(access_token).account_info()['display_name']
-        if user.last_target != 'dropbox':
-            user.target_settings = {'token': access_token, 'folder': '', 'files_revision': {}}
-            flash('Successfully logged in to Dropbox as %s' % dropbox_username, 'info')
-        else:
-            user.target_settings['token'] = access_token
-            flash('Successfully refreshed token for Dropbox user %s' % dropbox_username, 'info')
-        user.update()
+    dropbox_username = dropbox.client.DropboxClient(access_token).account_info()['display_name']
+
+    def login_dropbox(values):
+        if values['last_target'] != 'dropbox':
+            return {'target': 'dropbox', 'target_settings': {'token': access_token, 'folder': ''}}
+        values['target_settings']['token'] = access_token
+        return {'target': 'dropbox', 'target_settings': values['target_settings']}
+
+    if user.update_fields(login_dropbox, 'last_target', 'target_settings')['last_target'] != 'dropbox':
+        user.clear_file_revisions()
+        flash('Successfully logged in to Dropbox as %s' % dropbox_username, 'info')
+    else:
+        flash('Successfully refreshed token for Dropbox user %s' % dropbox_username, 'info')
     return redirect(url_for('dashboard'))
 
 
@@ -190,11 +188,13 @@ def dropbox_update_folder():
     dropbox_client = dropbox.client.DropboxClient(user.target_settings['token'])
     file_list = dropbox_client.search('/', '.Your_Workbin_Files')
     if file_list:
-        with user.lock:
-            user.sync_from_db()
-            new_path = file_list[0]['path']
-            user.target_settings['folder'] = new_path[:new_path.rfind('/') + 1]
-            user.update()
+        new_path = file_list[0]['path']
+
+        def set_folder(values):
+            values['target_settings']['folder'] = new_path[:new_path.rfind('/') + 1]
+            return values
+
+        user.update_fields(set_folder, 'target_settings')
         dropbox_client.file_delete(new_path)
         return user.target_settings['folder']
     else:
@@ -238,16 +238,16 @@ def auth_google_callback():
     except Exception as e:
         flash('Error: ' + str(e), 'warning')
         return redirect(url_for('dashboard'))
-    with user.lock:
-        user.sync_from_db()
-        user.target = 'google'
-        if user.last_target != 'google':
-            flash('Logged in to Google Drive.', 'info')
-            user.target_settings = {'credentials': credentials.to_json(), 'parent_id': ''}
-        else:
-            flash('Refreshed Google Drive token.', 'info')
-            user.target_settings['credentials'] = credentials.to_json()
-        user.update()
+    def login_google(values):
+        if values['last_target'] != 'google':
+            return {'target': 'google', 'target_settings': {'credentials': credentials.to_json(), 'parent_id': ''}}
+        values['target_settings']['credentials'] = credentials.to_json()
+        return {'target': 'google', 'target_settings': values['target_settings']}
+
+    if user.update_fields(login_google, 'last_target', 'target_settings')['last_target'] != 'google':
+        flash('Logged in to Google Drive.', 'info')
+    else:
+        flash('Refreshed Google Drive token.', 'info')
     return redirect(url_for('dashboard'))
 
 
@@ -297,10 +297,11 @@ def google_update_folder():
     params = {'q': "title = '.Your_Workbin_Files'"}
     files = apiclient.files().list(**params).execute()
     if len(files['items']) > 0:
-        with user.lock:
-            user.sync_from_db()
-            user.target_settings['parent_id'] = files['items'][0]['parents'][0]['id']
-            user.update()
+        def set_parent_id(values):
+            values['target_settings']['parent_id'] = files['items'][0]['parents'][0]['id']
+            return values
+
+        user.update_fields(set_parent_id, 'target_settings')
         apiclient.files().delete(fileId=files['items'][0]['id']).execute()
     else:
         pass  # TODO
@@ -360,16 +361,16 @@ def auth_onedrive_callback():
     except Exception as e:
         flash('Error: ' + str(e), 'warning')
         return redirect(url_for('dashboard'))
-    with user.lock:
-        user.sync_from_db()
-        user.target = 'onedrive'
-        if user.last_target != 'onedrive':
-            flash('Logged in to OneDrive.', 'info')
-            user.target_settings = {'credentials': credentials.to_json(), 'folder': ''}
-        else:
-            flash('Refreshed OneDrive token.', 'info')
-            user.target_settings['credentials'] = credentials.to_json()
-        user.update()
+    def login_onedrive(values):
+        if values['last_target'] != 'onedrive':
+            return {'target': 'onedrive', 'target_settings': {'credentials': credentials.to_json(), 'folder': ''}}
+        values['target_settings']['credentials'] = credentials.to_json()
+        return {'target': 'onedrive', 'target_settings': values['target_settings']}
+
+    if user.update_fields(login_onedrive, 'last_target', 'target_settings')['last_target'] != 'onedrive':
+        flash('Logged in to OneDrive.', 'info')
+    else:
+        flash('Refreshed OneDrive token.', 'info')
     return redirect(url_for('dashboard'))
 
 
@@ -0,0 +1,71 @@
+import logging
+import smtplib
+import socket
+import time
+from utils import db, mail
+from config import SMTP_USER, MAIL_BATCH_SIZE, MAIL_MAX_ATTEMPTS, MAIL_IDLE_TIMEOUT
+
+
+# A 5xx reply to the email itself, such as a refused sender or message. A refused login is the server or our settings, not the email.
+def is_permanent(e):
+    return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500 and not isinstance(e, smtplib.SMTPAuthenticationError)
+
+
+# Sends the emails put in the outbox by utils.mail over one logged in SMTP connection, which is kept open while there is mail and
+# closed after MAIL_IDLE_TIMEOUT seconds without. If the connection breaks it is opened again and the email retried; an email
+# refused MAIL_MAX_ATTEMPTS times is dropped.
+class Mailer():
+    def __init__(self):
+        self.smtp = None
+
+    def connect(self):
+        if self.smtp is None:
+            self.smtp = mail.get_logged_in_smtp_client()
+        return self.smtp
+
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def send(self, message):
+        try:
+            self.connect().sendmail(SMTP_USER, message['to'], message['content'])
+        except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):  # Not OSError, which every SMTPException is
+            self.disconnect()  # Once more on a new connection
+            self.connect().sendmail(SMTP_USER, message['to'], message['content'])
+
+    def run(self):
+        while True:
+            messages = db.pop_mails(MAIL_BATCH_SIZE, MAIL_IDLE_TIMEOUT)
+            if not messages:
+                self.disconnect()
+                continue
+            failed = []
+            for i, message in enumerate(messages):
+                try:
+                    self.send(message)
+                except smtplib.SMTPRecipientsRefused as e:
+                    logging.error("SMTP Error, dropping email to %s: %s" % (message['to'], str(e)))
+                except (smtplib.SMTPException, OSError) as e:
+                    if is_permanent(e):  # The server will never take this one, the rest of the batch may be fine
+                        logging.error("SMTP Error, dropping email to %s: %s" % (message['to'], str(e)))
+                        continue
+                    logging.error("SMTP Error: " + str(e))
+                    self.disconnect()
+                    message['attempts'] += 1
+                    if message['attempts'] < MAIL_MAX_ATTEMPTS:
+                        failed.append(message)
+                    failed.extend(messages[i + 1:])  # The server is unhappy, try the rest later
+                    break
+            if failed:
+                db.push_back_mails(failed)
+                time.sleep(min(60, 2 ** max(message['attempts'] for message in failed)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
+    Mailer().run()
@@ -1,16 +1,21 @@
 from utils import db, misc
-import random
-import string
-import redis_lock
+import copy
+import pickle
+import time
+from config import FILE_STATUS_TIMEOUT
 
 
 class User():
+    # Each field is stored on its own and only read the first time it is accessed, so checking e.g. enabled does not load the
+    # whole user. update() only writes the fields that differ from what was read, including dicts / lists changed in place.
+    # Nothing is locked: set_fields() overwrites fields outright and update_fields() retries a read-modify-write if the user changes.
+    FIELDS = {'email': None, 'ivle_token': '', 'modules': [], 'enabled': False, 'uploadable_folder': False, 'target': None, 'last_target': None,
+              'target_settings': {}, 'key': None}
+
     def __init__(self, user_id, user_email=None):
         self.user_id = user_id
-        self.lock = redis_lock.Lock(db.r, user_id)
-        if db.get_user_dict(user_id):
-            self.__dict__.update(db.get_user_dict(user_id))
-        else:
+        self.loaded_fields = {}
+        if not db.user_exists(user_id):
             self.email = user_email
             self.ivle_token = ''
             self.modules = []
@@ -19,34 +24,118 @@ class User():
             self.target = None
             self.last_target = None
             self.target_settings = {}
-            self.synced_files = []
             self.key = misc.generate_random_string(16)
             self.update()
 
     def update_ivle_token(self, new_token):
-        with self.lock:
-            self.sync_from_db()
-            self.ivle_token = new_token
-            self.update()
+        self.set_fields(ivle_token=new_token)
+
+    def disable(self):
+        self.set_fields(enabled=False)
+
+    def logout_target(self):
+        self.update_fields(lambda values: {'last_target': values['target'], 'target': None}, 'target')
 
     def unauth_target(self, clear_synced_files=True):
-        with self.lock:
-            self.sync_from_db()
-            self.last_target = None  # This should always be manually called by user so no need to save last_target
-            self.target = None
-            if clear_synced_files:
-                self.synced_files = []
-            self.enabled = False
-            self.update()
+        # This should always be manually called by user so no need to save last_target
+        self.set_fields(last_target=None, target=None, enabled=False)
+        if clear_synced_files:
+            db.clear_synced_files(self.user_id)
+            db.set_reconcile_pending(self.user_id)  # Files already in the next target are found by the next sync instead of uploaded again
+        db.clear_google_folders(self.user_id)
+        db.clear_onedrive_folders(self.user_id)
+
+    def is_file_synced(self, file_id):
+        return db.is_file_synced(self.user_id, file_id)
+
+    def mark_file_synced(self, file_id):
+        db.add_synced_file(self.user_id, file_id)
+
+    def mark_files_synced(self, file_ids):
+        db.add_synced_files(self.user_id, file_ids)
+
+    def filter_unsynced_files(self, file_list):
+        unsynced_ids = set(db.filter_unsynced_files(self.user_id, [file['ID'] for file in file_list]))
+        return [file for file in file_list if file['ID'] in unsynced_ids]
+
+    # Files waiting to be dispatched ('pending'), waiting in a batch job ('queued') or being transferred by one ('transferring'). A queued
+    # or transferring status older than FILE_STATUS_TIMEOUT is assumed to belong to a dead worker. Pending files are still in Redis,
+    # however long fair queueing keeps them there.
+    def filter_unqueued_files(self, file_list):
+        unqueued_ids = set(db.filter_files_without_status(self.user_id, [file['ID'] for file in file_list], FILE_STATUS_TIMEOUT))
+        return [file for file in file_list if file['ID'] in unqueued_ids]
+
+    def set_files_status(self, file_ids, status):
+        db.set_files_status(self.user_id, file_ids, status)
+
+    def clear_files_status(self, file_ids):
+        db.clear_files_status(self.user_id, file_ids)
+
+    # The files stay pending until the scheduler hands them to the file queue again after retry_after seconds.
+    def delay_files(self, files, retry_after):
+        if files:
+            db.set_files_status(self.user_id, [file['ID'] for file in files], 'pending')
+            db.delay_files(self.user_id, files, time.time() + retry_after)
+
+    def get_file_revision(self, path):
+        return db.get_file_revision(self.user_id, path)
+
+    def set_file_revision(self, path, revision):
+        db.set_file_revision(self.user_id, path, revision)
+
+    def clear_file_revisions(self):
+        db.clear_file_revisions(self.user_id)
+
+    def __getattr__(self, name):  # Only called for fields which have not been loaded yet
+        if name not in User.FIELDS:
+            raise AttributeError(name)
+        self.load(name)
+        return self.__dict__[name]
+
+    # Loads the given fields in one round trip.
+    def load(self, *fields):
+        values = db.get_user_fields(self.user_id, list(fields))
+        for field in fields:
+            self.__dict__[field] = values.get(field, copy.deepcopy(User.FIELDS[field]))
+            self.loaded_fields[field] = pickle.dumps(self.__dict__[field])
+
+    def set_fields(self, **fields):
+        db.set_user_fields(self.user_id, fields)
+        for field, value in fields.items():
+            self.__dict__[field] = value
+            self.loaded_fields[field] = pickle.dumps(value)
+
+    # func gets the current values of the given fields and returns the fields to write; it may be called more than once.
+    def update_fields(self, func, *fields):
+        def fill_defaults(values):
+            for field in fields:
+                if field not in values:
+                    values[field] = copy.deepcopy(User.FIELDS[field])
+            return values
+
+        new_fields = {}
 
-    def to_dict(self):
-        return self.__dict__
+        def modify(values):
+            new_fields.clear()
+            new_fields.update(func(fill_defaults(values)))
+            return new_fields
 
-    def sync_from_db(self):
-        self.__dict__.update(db.get_user_dict(self.user_id))
+        seen = fill_defaults(db.update_user_fields(self.user_id, list(fields), modify))
+        for field, value in list(seen.items()) + list(new_fields.items()):
+            self.__dict__[field] = value
+            self.loaded_fields[field] = pickle.dumps(value)
+        return seen
 
     def update(self):
-        db.update_user(self)
+        changed_fields = {}
+        for field in User.FIELDS:
+            if field in self.__dict__:
+                pickled_value = pickle.dumps(self.__dict__[field])
+                if pickled_value != self.loaded_fields.get(field):
+                    changed_fields[field] = self.__dict__[field]
+                    self.loaded_fields[field] = pickled_value
+        if changed_fields:
+            db.set_user_fields(self.user_id, changed_fields)
 
     def generate_emergency_code(self):
         return db.generate_user_emergency(self.user_id)
@@ -56,4 +145,4 @@ class User():
 
     @classmethod
     def user_exists(cls, user_id):
-        return bool(db.get_user_dict(user_id))
+        return db.user_exists(user_id)
@@ -1,15 +1,94 @@
 import worker
 import logging
-import threading
-from config import CRON_INTERVAL
+import random
+import time
+from utils import db, mail
+from config import CRON_INTERVAL, SCHEDULER_TICK, SCHEDULER_JITTER, SCHEDULER_IDLE_AFTER, SCHEDULER_MAX_INTERVAL, SCHEDULER_MAX_QUEUE_DEPTH, \
+    FILE_DISPATCH_INTERVAL, ERROR_DIGEST_INTERVAL
 
 
-def cron_job():
-    logging.info("Cron Started.")
-    worker.queue_all_user()
-    threading.Timer(CRON_INTERVAL, cron_job).start()
+# Users are kept in a sorted set by when they are next due, so every tick only queues the ones whose time has come instead of
+# everybody at once. A user with new files in the last SCHEDULER_IDLE_AFTER seconds is synced every CRON_INTERVAL; after that the
+# interval doubles for each idle period, up to SCHEDULER_MAX_INTERVAL.
+def sync_interval(last_change, now):
+    if last_change is None:
+        return CRON_INTERVAL
+    idle_periods = int(max(0, now - last_change) // SCHEDULER_IDLE_AFTER)
+    return min(CRON_INTERVAL * 2 ** min(idle_periods, 16), SCHEDULER_MAX_INTERVAL)
+
+
+def jittered(interval):
+    return interval * random.uniform(1 - SCHEDULER_JITTER, 1 + SCHEDULER_JITTER)
+
+
+def reconcile_schedule():
+    # Newly enabled users are spread over the first interval and start out as recently changed; users who have been disabled are dropped.
+    now = time.time()
+    enabled_users = set(db.scan_enabled_users())
+    scheduled_users = db.get_scheduled_users()
+    db.init_last_changes(enabled_users - scheduled_users, now)
+    db.schedule_users({user_id: now + random.uniform(0, CRON_INTERVAL) for user_id in enabled_users - scheduled_users})
+    db.unschedule_users(list(scheduled_users - enabled_users))
+    logging.info("Schedule: %d users, %d added, %d removed." % (len(enabled_users), len(enabled_users - scheduled_users),
+                                                                 len(scheduled_users - enabled_users)))
+
+
+def queue_depth():
+    return worker.user_queue.count + worker.file_queue.count + db.count_pending_file_batches(db.get_pending_users())
+
+
+def tick():
+    # Only top the queues (including batches waiting to be dispatched) up to SCHEDULER_MAX_QUEUE_DEPTH, so a backlog shrinks the tick
+    # instead of piling more work on top.
+    depth = queue_depth()
+    budget = SCHEDULER_MAX_QUEUE_DEPTH - depth
+    if budget <= 0:
+        logging.info("Queue depth %d, skipping tick." % depth)
+        return
+    now = time.time()
+    due_users = db.get_due_users(now, budget)
+    if not due_users:
+        return
+    user_names = [user_id for user_id, _ in due_users]
+    last_changes = db.get_last_changes(user_names)
+    db.schedule_users({user_id: now + jittered(sync_interval(last_changes.get(user_id), now)) for user_id in user_names})
+    worker.queue_users(user_names, dict(due_users))
+    logging.info("Queued %d due users, queue depth %d, oldest due %.0fs ago." % (len(due_users), depth, now - due_users[0][1]))
+
+
+def report_lag():
+    lags = db.get_schedule_lags()
+    if lags:
+        logging.info("Schedule lag: average %.0fs, max %.0fs over %d users." % (sum(lags.values()) / len(lags), max(lags.values()), len(lags)))
+    waits = db.get_file_queue_waits()
+    if waits:
+        logging.info("File queue wait: average %.0fs, max %.0fs over %d users." % (sum(waits.values()) / len(waits), max(waits.values()),
+                                                                                  len(waits)))
+
+
+def run():
+    last_reconciled = 0
+    last_tick = 0
+    last_digest = time.time()
+    while True:
+        try:
+            if time.time() - last_reconciled >= CRON_INTERVAL:
+                reconcile_schedule()
+                report_lag()
+                last_reconciled = time.time()
+            if time.time() - last_tick >= SCHEDULER_TICK:
+                tick()
+                last_tick = time.time()
+            if time.time() - last_digest >= ERROR_DIGEST_INTERVAL:
+                mail.send_error_digest()
+                last_digest = time.time()
+            worker.queue_delayed_files()
+            worker.dispatch_file_batches()
+        except Exception:
+            logging.exception("Scheduler tick failed.")
+        time.sleep(FILE_DISPATCH_INTERVAL)
 
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.DEBUG)
-    cron_job()
+    run()
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import tempfile
+from utils import db
+from config import BLOB_CACHE_DIR, BLOB_CACHE_SIZE, TRANSFER_CHUNK_SIZE
+
+
+# Files downloaded from IVLE are kept on disk so that everyone taking a course gets the same file from one download. Blobs are
+# evicted least recently used first once the cache is over BLOB_CACHE_SIZE bytes; reading a blob counts as using it. The size of
+# the cache is kept as a running total in Redis, corrected every time the directory is walked.
+def blob_path(key):
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(BLOB_CACHE_DIR, name[:2], name)
+
+
+def is_cacheable(size):
+    return bool(BLOB_CACHE_DIR) and size is not None and 0 < size <= BLOB_CACHE_SIZE // 10
+
+
+class CachedFile():
+    # Reads like an IVLEFile.
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def skip(self, size):
+        self.file.seek(size, os.SEEK_CUR)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(TRANSFER_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_blob(key):
+    path = blob_path(key)
+    try:
+        file = CachedFile(path)
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass  # Evicted in between, the open file is still readable
+    return file
+
+
+# Stores what file yields under key and returns the cached copy. The blob only appears once it is complete, and only if it has as
+# many bytes as the file said it has.
+def store_blob(key, file):
+    path = blob_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        length = 0
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk in file:
+                temp_file.write(chunk)
+                length += len(chunk)
+        if file.size is not None and length != file.size:
+            raise IOError("Download of %s ended after %d of %d bytes." % (key, length, file.size))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    cached_file = CachedFile(path)
+    (total, known) = db.add_blob_cache_size(cached_file.size)
+    if total > BLOB_CACHE_SIZE or not known:  # The directory is only walked when it may be over the limit
+        evict()
+    return cached_file
+
+
+def evict():
+    blobs = []
+    for directory, _, names in os.walk(BLOB_CACHE_DIR):
+        for name in names:
+            if name.startswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+    total = sum(size for _, size, _ in blobs)
+    for _, size, path in sorted(blobs):
+        if total <= BLOB_CACHE_SIZE * 0.9:  # Some room, so the next few blobs stored do not walk the directory again
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    db.set_blob_cache_size(total)
@@ -2,20 +2,68 @@ from config import REDIS_HOST, REDIS_PORT, REDIS_DB
 from utils.misc import generate_random_string
 
 import redis
+import redis_lock
 import pickle
+import socket
+import time
 
 r = redis.Redis(REDIS_HOST, REDIS_PORT, REDIS_DB)
 
 PREFIX = 'IVLED2:'
 
-PREFIX_USER = PREFIX + 'USER:'
+PREFIX_USER = PREFIX + 'USER:'  # Old pickled user records, see migrate_user
+PREFIX_USER_FIELDS = PREFIX + 'USER_FIELDS:'
+PREFIX_FILES_REVISION = PREFIX + 'FILES_REVISION:'
 SET_NAME_USER = PREFIX + 'USERS'
+SET_NAME_ENABLED_USER = PREFIX + 'ENABLED_USERS'
 
 PREFIX_EMERGENCY_LOGIN = PREFIX + 'EMERGENCY:'
 
+PREFIX_SYNCED_FILES = PREFIX + 'SYNCED:'
+PREFIX_FILES_STATUS = PREFIX + 'FILES_STATUS:'
+LIST_NAME_OUTBOX = PREFIX + 'OUTBOX'  # Emails waiting for mailer.py
+PREFIX_QUOTA_NOTIFIED = PREFIX + 'QUOTA_NOTIFIED:'
+SET_NAME_RECONCILE_PENDING = PREFIX + 'RECONCILE_PENDING'  # Users whose synced files should be rebuilt from what is in their target
+HASH_NAME_RECONCILE_FAILURES = PREFIX + 'RECONCILE_FAILURES'  # Failed attempts at it so far, per user
+HASH_NAME_ERROR_COUNTS = PREFIX + 'ERROR_COUNTS'  # Errors reported to the admins since the last digest, per fingerprint
+PREFIX_ERROR_SAMPLES = PREFIX + 'ERROR_SAMPLES:'
+PREFIX_ERROR_NOTIFIED = PREFIX + 'ERROR_NOTIFIED:'
 
-def set_value(key, value):
-    r.set(key, pickle.dumps(value))
+PREFIX_SEMAPHORE = PREFIX + 'SEMAPHORE:'
+
+PREFIX_WORKBIN = PREFIX + 'COURSE_WORKBIN:'
+PREFIX_WORKBIN_LOCK = PREFIX + 'COURSE_WORKBIN_LOCK:'
+
+PREFIX_TOKEN_VALIDATED = PREFIX + 'TOKEN_VALIDATED:'
+
+PREFIX_SETTINGS_VERIFIED = PREFIX + 'SETTINGS_VERIFIED:'
+
+PREFIX_GOOGLE_FOLDERS = PREFIX + 'GOOGLE_FOLDERS:'
+PREFIX_GOOGLE_FOLDER_LOCK = PREFIX + 'GOOGLE_FOLDER_LOCK:'
+PREFIX_ONEDRIVE_FOLDERS = PREFIX + 'ONEDRIVE_FOLDERS:'
+
+SCHEDULE = PREFIX + 'SCHEDULE'  # Sorted set of enabled users scored by when they are next due
+HASH_NAME_LAST_CHANGE = PREFIX + 'LAST_CHANGE'  # When new files were last found for each user
+PREFIX_LISTED_FILES = PREFIX + 'LISTED_FILES:'  # IDs of the files in each user's last IVLE listing
+HASH_NAME_SCHEDULE_LAG = PREFIX + 'SCHEDULE_LAG'  # Seconds between each user being due and their last sync starting
+
+PREFIX_PENDING_FILES = PREFIX + 'PENDING_FILES:'  # Batches of files waiting to be handed to the file queue, per user
+SET_NAME_PENDING_USER = PREFIX + 'PENDING_USERS'
+HASH_NAME_FILE_QUEUE_WAIT = PREFIX + 'FILE_QUEUE_WAIT'  # Seconds the last batch of each user waited before a worker picked it up
+DELAYED_FILES = PREFIX + 'DELAYED_FILES'  # Files to try again once a provider stops throttling, scored by when
+
+PREFIX_UPLOAD_SESSION = PREFIX + 'UPLOAD_SESSION:'  # Unfinished uploads to resume, per user and file
+PREFIX_BLOB_LOCK = PREFIX + 'BLOB_LOCK:'
+PREFIX_BLOB_CACHE_SIZE = PREFIX + 'BLOB_CACHE_SIZE:'  # Bytes in the blob cache of each host, as of the last scan plus blobs stored since
+PREFIX_DROPBOX_COPY_REF = PREFIX + 'DROPBOX_COPY_REF:'
+
+PREFIX_RATE_LIMIT = PREFIX + 'RATE_LIMIT:'
+PREFIX_RATE_LIMIT_FAILURES = PREFIX + 'RATE_LIMIT_FAILURES:'
+PREFIX_SERVER_ERRORS = PREFIX + 'SERVER_ERRORS:'  # Server errors per bucket in the current SERVER_ERROR_WINDOW
+
+
+def set_value(key, value, expire=None):
+    r.set(key, pickle.dumps(value), ex=expire)
 
 
 def get_value(key):
@@ -25,23 +73,559 @@ def get_value(key):
     return pickle.loads(pickled_value)
 
 
-def get_user_dict(user_id):
-    return get_value(PREFIX_USER + user_id)
+def user_exists(user_id):
+    return bool(r.exists(PREFIX_USER_FIELDS + user_id)) or migrate_user(user_id)
+
+
+def get_user_fields(user_id, fields):
+    values = r.hmget(PREFIX_USER_FIELDS + user_id, fields)
+    return {field: pickle.loads(value) for field, value in zip(fields, values) if value is not None}
+
+
+def set_user_fields(user_id, fields):
+    pipe = r.pipeline()
+    queue_user_fields(pipe, user_id, fields)
+    pipe.execute()
+
+
+def queue_user_fields(pipe, user_id, fields):
+    pipe.sadd(SET_NAME_USER, user_id)
+    pipe.hmset(PREFIX_USER_FIELDS + user_id, {field: pickle.dumps(value) for field, value in fields.items()})
+    if 'enabled' in fields:
+        if fields['enabled']:
+            pipe.sadd(SET_NAME_ENABLED_USER, user_id)
+            pipe.zadd(SCHEDULE, **{user_id: time.time()})  # Due straight away
+        else:
+            pipe.srem(SET_NAME_ENABLED_USER, user_id)
+            pipe.zrem(SCHEDULE, user_id)
+
+
+# Read-modify-write of some fields without a lock: func gets the current values of the fields and returns the ones to write. If any
+# field of the user is written in between, the transaction is retried with the new values. Returns the values func last saw.
+def update_user_fields(user_id, fields, func):
+    key = PREFIX_USER_FIELDS + user_id
+    seen = {}
+
+    def transaction(pipe):
+        values = pipe.hmget(key, fields)
+        seen.clear()
+        seen.update({field: pickle.loads(value) for field, value in zip(fields, values) if value is not None})
+        new_fields = func({field: pickle.loads(value) for field, value in zip(fields, values) if value is not None})
+        pipe.multi()
+        if new_fields:
+            queue_user_fields(pipe, user_id, new_fields)
+
+    r.transaction(transaction, key)
+    return seen
+
+
+def migrate_user(user_id):
+    # Users saved before fields were stored separately are a single pickled dict, with their synced files and Dropbox revisions inside.
+    user_dict = get_value(PREFIX_USER + user_id)
+    if user_dict is None:
+        return bool(r.exists(PREFIX_USER_FIELDS + user_id))  # Someone else may have just migrated it
+    user_dict.pop('user_id', None)
+    user_dict.pop('lock', None)
+    synced_files = user_dict.pop('synced_files', [])
+    files_revision = user_dict.get('target_settings', {}).pop('files_revision', {})
+    pipe = r.pipeline()
+    if synced_files:
+        pipe.sadd(PREFIX_SYNCED_FILES + user_id, *synced_files)
+    if files_revision:
+        pipe.hmset(PREFIX_FILES_REVISION + user_id, files_revision)
+    pipe.hmset(PREFIX_USER_FIELDS + user_id, {field: pickle.dumps(value) for field, value in user_dict.items()})
+    if user_dict.get('enabled'):
+        pipe.sadd(SET_NAME_ENABLED_USER, user_id)
+    pipe.delete(PREFIX_USER + user_id)
+    pipe.execute()
+    return True
 
 
-def update_user(user):
-    add_user_to_set(user.user_id)
-    d = user.to_dict().copy()
-    d.pop('lock', None)
-    return set_value(PREFIX_USER + user.user_id, d)
+def migrate_all_users():
+    for user_id in get_users():
+        migrate_user(user_id.decode('utf-8'))
+    rebuild_enabled_users()
+
+
+def get_file_revision(user_id, path):
+    revision = r.hget(PREFIX_FILES_REVISION + user_id, path)
+    return revision.decode('utf-8') if revision else ''
+
+
+def set_file_revision(user_id, path, revision):
+    return r.hset(PREFIX_FILES_REVISION + user_id, path, revision)
+
+
+def clear_file_revisions(user_id):
+    return r.delete(PREFIX_FILES_REVISION + user_id)
 
 
 def get_users():
     return r.smembers(SET_NAME_USER)
 
 
-def add_user_to_set(user_id):
-    return r.sadd(SET_NAME_USER, user_id)
+def scan_enabled_users():
+    if not r.exists(SET_NAME_ENABLED_USER):  # Not built yet, or nobody is enabled
+        migrate_all_users()
+    return (user_id.decode('utf-8') for user_id in r.sscan_iter(SET_NAME_ENABLED_USER, count=1000))
+
+
+def rebuild_enabled_users():
+    user_ids = list(get_users())
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hget(PREFIX_USER_FIELDS + user_id.decode('utf-8'), 'enabled')
+    enabled_users = [user_id for user_id, enabled in zip(user_ids, pipe.execute()) if enabled and pickle.loads(enabled)]
+    pipe = r.pipeline()
+    pipe.delete(SET_NAME_ENABLED_USER)
+    if enabled_users:
+        pipe.sadd(SET_NAME_ENABLED_USER, *enabled_users)
+    pipe.execute()
+
+
+def is_file_synced(user_id, file_id):
+    return r.sismember(PREFIX_SYNCED_FILES + user_id, file_id)
+
+
+def filter_unsynced_files(user_id, file_ids):
+    pipe = r.pipeline(transaction=False)
+    for file_id in file_ids:
+        pipe.sismember(PREFIX_SYNCED_FILES + user_id, file_id)
+    return [file_id for file_id, synced in zip(file_ids, pipe.execute()) if not synced]
+
+
+def add_synced_file(user_id, file_id):
+    return r.sadd(PREFIX_SYNCED_FILES + user_id, file_id)
+
+
+def add_synced_files(user_id, file_ids):
+    if file_ids:
+        return r.sadd(PREFIX_SYNCED_FILES + user_id, *file_ids)
+
+
+def clear_synced_files(user_id):
+    return r.delete(PREFIX_SYNCED_FILES + user_id)
+
+
+def push_mail(mail):
+    return r.rpush(LIST_NAME_OUTBOX, pickle.dumps(mail))
+
+
+def push_back_mails(mails):  # To the front, so they are sent first
+    if mails:
+        r.lpush(LIST_NAME_OUTBOX, *[pickle.dumps(mail) for mail in reversed(mails)])
+
+
+# Waits up to timeout seconds for mail, then takes up to limit at once.
+def pop_mails(limit, timeout):
+    item = r.blpop(LIST_NAME_OUTBOX, timeout)
+    if item is None:
+        return []
+    pipe = r.pipeline()
+    pipe.lrange(LIST_NAME_OUTBOX, 0, limit - 2)
+    pipe.ltrim(LIST_NAME_OUTBOX, limit - 1, -1)
+    return [pickle.loads(mail) for mail in [item[1]] + pipe.execute()[0]]
+
+
+# True for the first caller within expire seconds.
+def claim_quota_notification(user_id, expire):
+    return bool(r.set(PREFIX_QUOTA_NOTIFIED + user_id, 1, ex=expire, nx=True))
+
+
+# Returns how many times the error has been seen since the last digest, and whether it is the first in window seconds.
+def count_error(fingerprint, window):
+    pipe = r.pipeline()
+    pipe.hincrby(HASH_NAME_ERROR_COUNTS, fingerprint, 1)
+    pipe.set(PREFIX_ERROR_NOTIFIED + fingerprint, 1, ex=window, nx=True)
+    (count, first) = pipe.execute()
+    return count, bool(first)
+
+
+def add_error_sample(fingerprint, sample):
+    return r.rpush(PREFIX_ERROR_SAMPLES + fingerprint, sample)
+
+
+# Takes the counts and samples gathered since the last digest, as {fingerprint: (count, samples)}.
+def pop_errors():
+    pipe = r.pipeline()
+    pipe.hgetall(HASH_NAME_ERROR_COUNTS)
+    pipe.delete(HASH_NAME_ERROR_COUNTS)
+    counts = {fingerprint.decode('utf-8'): int(count) for fingerprint, count in pipe.execute()[0].items()}
+    pipe = r.pipeline()
+    for fingerprint in counts:
+        pipe.lrange(PREFIX_ERROR_SAMPLES + fingerprint, 0, -1)
+        pipe.delete(PREFIX_ERROR_SAMPLES + fingerprint)
+    samples = pipe.execute()[::2]
+    return {fingerprint: (counts[fingerprint], [sample.decode('utf-8') for sample in fingerprint_samples])
+            for fingerprint, fingerprint_samples in zip(counts, samples)}
+
+
+def set_reconcile_pending(user_id):
+    pipe = r.pipeline()
+    pipe.sadd(SET_NAME_RECONCILE_PENDING, user_id)
+    pipe.hdel(HASH_NAME_RECONCILE_FAILURES, user_id)
+    pipe.execute()
+
+
+def is_reconcile_pending(user_id):
+    return r.sismember(SET_NAME_RECONCILE_PENDING, user_id)
+
+
+def count_reconcile_failure(user_id):
+    return r.hincrby(HASH_NAME_RECONCILE_FAILURES, user_id, 1)
+
+
+def clear_reconcile_pending(user_id):
+    pipe = r.pipeline()
+    pipe.srem(SET_NAME_RECONCILE_PENDING, user_id)
+    pipe.hdel(HASH_NAME_RECONCILE_FAILURES, user_id)
+    pipe.execute()
+
+
+def set_files_status(user_id, file_ids, status):
+    if file_ids:
+        value = pickle.dumps({'status': status, 'time': time.time()})
+        r.hmset(PREFIX_FILES_STATUS + user_id, {file_id: value for file_id in file_ids})
+
+
+def filter_files_without_status(user_id, file_ids, timeout):
+    if not file_ids:
+        return []
+    now = time.time()
+    statuses = r.hmget(PREFIX_FILES_STATUS + user_id, file_ids)
+    statuses = [pickle.loads(status) if status is not None else None for status in statuses]
+    return [file_id for file_id, status in zip(file_ids, statuses)
+            if status is None or (status['status'] != 'pending' and now - status['time'] > timeout)]
+
+
+def clear_files_status(user_id, file_ids):
+    if file_ids:
+        r.hdel(PREFIX_FILES_STATUS + user_id, *file_ids)
+
+
+def get_workbin_cache(course_id, uploadable_folder):
+    return get_value('%s%s:%d' % (PREFIX_WORKBIN, course_id, uploadable_folder))
+
+
+def set_workbin_cache(course_id, uploadable_folder, cache, expire):
+    return set_value('%s%s:%d' % (PREFIX_WORKBIN, course_id, uploadable_folder), cache, expire)
+
+
+def get_workbin_lock(course_id, uploadable_folder, expire):
+    return redis_lock.Lock(r, '%s%s:%d' % (PREFIX_WORKBIN_LOCK, course_id, uploadable_folder), expire=expire,
+                           auto_renewal=True)  # A refresh may wait on request slots and the rate limiter as well as IVLE
+
+
+def get_upload_session(user_id, key):
+    return get_value('%s%s:%s' % (PREFIX_UPLOAD_SESSION, user_id, key))
+
+
+def set_upload_session(user_id, key, session, expire):
+    set_value('%s%s:%s' % (PREFIX_UPLOAD_SESSION, user_id, key), session, expire)
+
+
+def clear_upload_session(user_id, key):
+    return r.delete('%s%s:%s' % (PREFIX_UPLOAD_SESSION, user_id, key))
+
+
+# Per host, as the blob cache is on local disk and a download on another machine is of no use here.
+def get_blob_lock(key, expire):
+    return redis_lock.Lock(r, '%s%s:%s' % (PREFIX_BLOB_LOCK, socket.gethostname(), key), expire=expire,
+                           auto_renewal=True)  # Held for as long as the download takes
+
+
+# Returns the new total, and whether it was known before.
+def add_blob_cache_size(size):
+    pipe = r.pipeline()
+    pipe.exists(PREFIX_BLOB_CACHE_SIZE + socket.gethostname())
+    pipe.incrby(PREFIX_BLOB_CACHE_SIZE + socket.gethostname(), size)
+    (known, total) = pipe.execute()
+    return total, bool(known)
+
+
+def set_blob_cache_size(size):
+    return r.set(PREFIX_BLOB_CACHE_SIZE + socket.gethostname(), size)
+
+
+def get_dropbox_copy_ref(key):
+    copy_ref = r.get(PREFIX_DROPBOX_COPY_REF + key)
+    return copy_ref.decode('utf-8') if copy_ref else None
+
+
+def set_dropbox_copy_ref(key, copy_ref, expire):
+    return r.set(PREFIX_DROPBOX_COPY_REF + key, copy_ref, ex=expire)
+
+
+def clear_dropbox_copy_ref(key):
+    return r.delete(PREFIX_DROPBOX_COPY_REF + key)
+
+
+def set_token_validated(user_id, expire):
+    return r.set(PREFIX_TOKEN_VALIDATED + user_id, 1, ex=expire)
+
+
+def is_token_validated(user_id):
+    return bool(r.exists(PREFIX_TOKEN_VALIDATED + user_id))
+
+
+def clear_token_validated(user_id):
+    return r.delete(PREFIX_TOKEN_VALIDATED + user_id)
+
+
+def set_settings_verified(fingerprint, expire):
+    return r.set(PREFIX_SETTINGS_VERIFIED + fingerprint, 1, ex=expire)
+
+
+def is_settings_verified(fingerprint):
+    return bool(r.exists(PREFIX_SETTINGS_VERIFIED + fingerprint))
+
+
+def clear_settings_verified(fingerprint):
+    return r.delete(PREFIX_SETTINGS_VERIFIED + fingerprint)
+
+
+def get_google_folders(user_id, paths):
+    if not paths:
+        return []
+    return r.hmget(PREFIX_GOOGLE_FOLDERS + user_id, paths)
+
+
+def set_google_folder(user_id, path, folder_id):
+    return r.hset(PREFIX_GOOGLE_FOLDERS + user_id, path, folder_id)
+
+
+def get_google_folder_lock(user_id, parent_id, title):
+    return redis_lock.Lock(r, '%s%s:%s:%s' % (PREFIX_GOOGLE_FOLDER_LOCK, user_id, parent_id, title), expire=60, auto_renewal=True)
+
+
+def clear_google_folders(user_id):
+    return r.delete(PREFIX_GOOGLE_FOLDERS + user_id)
+
+
+def are_onedrive_folders_known(user_id, paths):
+    pipe = r.pipeline(transaction=False)
+    for path in paths:
+        pipe.sismember(PREFIX_ONEDRIVE_FOLDERS + user_id, path)
+    return pipe.execute()
+
+
+def add_onedrive_folder(user_id, path):
+    return r.sadd(PREFIX_ONEDRIVE_FOLDERS + user_id, path)
+
+
+def clear_onedrive_folders(user_id):
+    return r.delete(PREFIX_ONEDRIVE_FOLDERS + user_id)
+
+
+def get_due_users(now, limit):
+    return [(user_id.decode('utf-8'), due) for user_id, due in r.zrangebyscore(SCHEDULE, '-inf', now, start=0, num=limit, withscores=True)]
+
+
+def schedule_users(due_times):
+    if due_times:
+        r.zadd(SCHEDULE, **due_times)
+
+
+def unschedule_users(user_ids):
+    if user_ids:
+        r.zrem(SCHEDULE, *user_ids)
+
+
+def get_scheduled_users():
+    return {user_id.decode('utf-8') for user_id, _ in r.zscan_iter(SCHEDULE)}
+
+
+def get_last_changes(user_ids):
+    if not user_ids:
+        return {}
+    return {user_id: float(changed) for user_id, changed in zip(user_ids, r.hmget(HASH_NAME_LAST_CHANGE, user_ids)) if changed is not None}
+
+
+def init_last_changes(user_ids, changed):
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hsetnx(HASH_NAME_LAST_CHANGE, user_id, changed)
+    pipe.execute()
+
+
+def set_last_change(user_id, changed):
+    return r.hset(HASH_NAME_LAST_CHANGE, user_id, changed)
+
+
+# Replaces the user's last listing with file_ids and returns the IDs which were not in it.
+def replace_listed_files(user_id, file_ids):
+    key = PREFIX_LISTED_FILES + user_id
+    pipe = r.pipeline()
+    pipe.delete(key + ':NEW')
+    if file_ids:
+        pipe.sadd(key + ':NEW', *file_ids)
+    pipe.sdiff(key + ':NEW', key)
+    if file_ids:
+        pipe.rename(key + ':NEW', key)
+    else:
+        pipe.delete(key)
+    return {file_id.decode('utf-8') for file_id in pipe.execute()[-2]}
+
+
+def set_schedule_lag(user_id, lag):
+    return r.hset(HASH_NAME_SCHEDULE_LAG, user_id, lag)
+
+
+def get_schedule_lags():
+    return {user_id.decode('utf-8'): float(lag) for user_id, lag in r.hgetall(HASH_NAME_SCHEDULE_LAG).items()}
+
+
+def push_file_batches(user_id, batches):
+    pipe = r.pipeline()
+    pipe.rpush(PREFIX_PENDING_FILES + user_id, *[pickle.dumps(batch) for batch in batches])
+    pipe.sadd(SET_NAME_PENDING_USER, user_id)
+    pipe.execute()
+
+
+def get_pending_users():
+    return [user_id.decode('utf-8') for user_id in r.smembers(SET_NAME_PENDING_USER)]
+
+
+def peek_file_batch(user_id):
+    batch = r.lindex(PREFIX_PENDING_FILES + user_id, 0)
+    return pickle.loads(batch) if batch is not None else None
+
+
+def peek_file_batches(user_ids):  # In one round trip
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.lindex(PREFIX_PENDING_FILES + user_id, 0)
+    return [pickle.loads(batch) if batch is not None else None for batch in pipe.execute()]
+
+
+def pop_file_batch(user_id):
+    batch = r.lpop(PREFIX_PENDING_FILES + user_id)
+    return pickle.loads(batch) if batch is not None else None
+
+
+def remove_pending_user_if_empty(user_id):
+    # Watched so that a batch pushed in between keeps the user in the set.
+    key = PREFIX_PENDING_FILES + user_id
+
+    def transaction(pipe):
+        empty = not pipe.llen(key)
+        pipe.multi()
+        if empty:
+            pipe.srem(SET_NAME_PENDING_USER, user_id)
+
+    r.transaction(transaction, key)
+
+
+def count_pending_file_batches(user_ids):
+    pipe = r.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.llen(PREFIX_PENDING_FILES + user_id)
+    return sum(pipe.execute())
+
+
+def set_file_queue_wait(user_id, wait):
+    return r.hset(HASH_NAME_FILE_QUEUE_WAIT, user_id, wait)
+
+
+def get_file_queue_waits():
+    return {user_id.decode('utf-8'): float(wait) for user_id, wait in r.hgetall(HASH_NAME_FILE_QUEUE_WAIT).items()}
+
+
+def delay_files(user_id, files, due):
+    # Pickled members are bytes and cannot be keyword arguments, so they go in as name1, score1, ... like the legacy Redis.zadd takes.
+    if files:
+        r.zadd(DELAYED_FILES, *[arg for file in files for arg in (pickle.dumps((user_id, file)), due)])
+
+
+def pop_due_delayed_files(now):
+    pipe = r.pipeline()
+    pipe.zrangebyscore(DELAYED_FILES, '-inf', now)
+    pipe.zremrangebyscore(DELAYED_FILES, '-inf', now)
+    return [pickle.loads(item) for item in pipe.execute()[0]]
+
+
+# Token buckets, one hash per name holding the tokens left, when they were counted and until when the name is blocked after being
+# throttled. All buckets are taken from at once or not at all; otherwise the script returns how long to wait.
+take_tokens_script = r.register_script('''
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'updated', 'blocked')
+    local updated = tonumber(state[2]) or now
+    tokens[i] = math.min(burst, (tonumber(state[1]) or burst) + math.max(0, now - updated) * rate)
+    if tokens[i] < 1 then
+        wait = math.max(wait, (1 - tokens[i]) / rate)
+    end
+    if (tonumber(state[3]) or 0) > now then
+        wait = math.max(wait, tonumber(state[3]) - now)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HMSET', key, 'tokens', tostring(tokens[i] - 1), 'updated', tostring(now))
+    redis.call('EXPIRE', key, 3600)
+end
+return '0'
+''')
+
+
+def take_tokens(names, limits):
+    args = [time.time()]
+    for rate, burst in limits:
+        args += [rate, burst]
+    return float(take_tokens_script(keys=[PREFIX_RATE_LIMIT + name for name in names], args=args))
+
+
+def count_rate_limit_failure(name, expire):
+    pipe = r.pipeline()
+    pipe.incr(PREFIX_RATE_LIMIT_FAILURES + name)
+    pipe.expire(PREFIX_RATE_LIMIT_FAILURES + name, expire)
+    return pipe.execute()[0]
+
+
+def reset_rate_limit_failures(names):
+    return r.delete(*[PREFIX_RATE_LIMIT_FAILURES + name for name in names])
+
+
+# Counted in fixed windows starting with the first error.
+def count_server_errors(names, window):
+    pipe = r.pipeline()
+    for name in names:
+        pipe.set(PREFIX_SERVER_ERRORS + name, 0, ex=window, nx=True)
+        pipe.incr(PREFIX_SERVER_ERRORS + name)
+    return pipe.execute()[1::2]
+
+
+def block_rate_limit(name, until):
+    pipe = r.pipeline()
+    pipe.hset(PREFIX_RATE_LIMIT + name, 'blocked', until)
+    pipe.expire(PREFIX_RATE_LIMIT + name, max(3600, int(until - time.time()) + 60))
+    pipe.execute()
+
+
+def acquire_semaphore(name, limit, timeout):
+    # Counting semaphore shared by all processes. Holders are kept in a sorted set scored by acquire time,
+    # and anyone holding it for longer than timeout seconds is assumed dead.
+    key = PREFIX_SEMAPHORE + name
+    token = generate_random_string(16)
+    now = time.time()
+    pipe = r.pipeline()
+    pipe.zremrangebyscore(key, '-inf', now - timeout)
+    pipe.zadd(key, **{token: now})
+    pipe.zrank(key, token)
+    if pipe.execute()[-1] < limit:
+        return token
+    r.zrem(key, token)
+    return None
+
+
+def release_semaphore(name, token):
+    return r.zrem(PREFIX_SEMAPHORE + name, token)
 
 
 def generate_user_emergency(user_id):
@@ -0,0 +1,91 @@
+import collections
+import random
+
+
+# Deficit round robin over per-user queues. Every round each user with work is credited quantum bytes and may dispatch batches from
+# the head of its queue while it has enough credit, so a user with hundreds of files only gets its share of the workers and a user
+# with a single small file gets through within a round. Credit is dropped when a user's queue runs empty.
+class DeficitRoundRobin():
+    def __init__(self, quantum):
+        self.quantum = quantum
+        self.deficits = {}
+        self.last_user = None
+
+    # head_cost(user) returns the cost of the first batch of the user or None if there is none, pop(user) dispatches it.
+    # Returns how many batches were dispatched, at most limit.
+    def dispatch(self, users, head_cost, pop, limit):
+        users = sorted(users)
+        if self.last_user in users:  # Carry on from where the last call stopped
+            start = users.index(self.last_user) + 1
+            users = users[start:] + users[:start]
+        for user in list(self.deficits):
+            if user not in users:
+                del self.deficits[user]
+        dispatched = 0
+        while users and dispatched < limit:
+            for user in list(users):
+                self.deficits[user] = self.deficits.get(user, 0) + self.quantum
+                cost = head_cost(user)
+                while cost is not None and cost <= self.deficits[user] and dispatched < limit:
+                    pop(user)
+                    self.deficits[user] -= cost
+                    self.last_user = user
+                    dispatched += 1
+                    cost = head_cost(user)
+                if cost is None:
+                    self.deficits.pop(user, None)
+                    users.remove(user)
+                if dispatched >= limit:
+                    break
+        return dispatched
+
+
+def simulate(arrivals, workers, bandwidth, quantum=None):
+    # arrivals is a list of (time, user, size). Each batch holds one file and takes size / bandwidth seconds on one of the workers.
+    # Without quantum files are served first come first served like a plain rq queue. Returns the waits of each user.
+    arrivals = sorted(arrivals)
+    queues = collections.defaultdict(collections.deque)
+    fifo = collections.deque()
+    drr = DeficitRoundRobin(quantum) if quantum else None
+    waits = collections.defaultdict(list)
+    free_at = [0.0] * workers
+    now = 0.0
+    i = 0
+    while i < len(arrivals) or fifo or any(queues.values()):
+        now = max(now, min(free_at))
+        if not (fifo or any(queues.values())):
+            now = max(now, arrivals[i][0])
+        while i < len(arrivals) and arrivals[i][0] <= now:
+            arrival_time, user, size = arrivals[i]
+            (queues[user] if drr else fifo).append((arrival_time, user, size))
+            i += 1
+        idle = [worker for worker in range(workers) if free_at[worker] <= now]
+        picked = []
+        if drr:
+            drr.dispatch([user for user in queues if queues[user]], lambda user: queues[user][0][2] if queues[user] else None,
+                         lambda user: picked.append(queues[user].popleft()), len(idle))
+        else:
+            while fifo and len(picked) < len(idle):
+                picked.append(fifo.popleft())
+        for worker, (arrival_time, user, size) in zip(idle, picked):
+            waits[user].append(now - arrival_time)
+            free_at[worker] = now + size / bandwidth
+        if not picked and i < len(arrivals):
+            now = max(now, arrivals[i][0])
+    return waits
+
+
+def report(name, waits):
+    small = sorted(wait for user, user_waits in waits.items() if user != 'backfill' for wait in user_waits)
+    print('%-6s other users: mean wait %7.1fs, p95 %7.1fs, max %7.1fs | backfill finished waiting after %7.1fs' % (
+        name, sum(small) / len(small), small[int(len(small) * 0.95)], small[-1], max(waits['backfill'])))
+
+
+if __name__ == '__main__':
+    # Queue latency benchmark: one new user backfilling 800 files while 50 others each get a couple of fresh lecture notes.
+    # Run with python -m utils.fairqueue
+    random.seed(0)
+    arrivals = [(0.0, 'backfill', random.uniform(1, 20) * 1024 * 1024) for _ in range(800)]
+    arrivals += [(random.uniform(0, 600), 'user%d' % user, random.uniform(0.2, 5) * 1024 * 1024) for user in range(50) for _ in range(2)]
+    for name, quantum in [('FIFO', None), ('DRR', 8 * 1024 * 1024)]:
+        report(name, simulate(arrivals, workers=8, bandwidth=1024 * 1024, quantum=quantum))
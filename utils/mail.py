@@ -1,9 +1,13 @@
-from config import SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_FROM, MODULE_VERSION, ADMIN_EMAILS
+from config import SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_FROM, MODULE_VERSION, ADMIN_EMAILS, ERROR_MAIL_WINDOW, \
+    ERROR_DIGEST_SAMPLES
 
-import logging
 import gzip, zlib
 import base64
+import os
 import smtplib
+import sys
+import traceback
+from utils import db
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -22,6 +26,12 @@ The link can only be used within 30 minutes and can only be used once.
 If you have not requested it, you may safely delete this email.
 '''
 
+QUOTA_FORMAT = '''There is not enough space left in your %s for %d new files from IVLE, so we have not transferred them:
+
+%s
+
+They will be transferred once there is enough space again.'''
+
 SIGN = '''
 
 This is a system generated email, please do not reply. Please contact support@sshz.org if you have any question.
@@ -34,13 +44,15 @@ def get_smtp_client():
     return smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
 
 
+def get_logged_in_smtp_client():
+    smtp = get_smtp_client()
+    smtp.login(SMTP_USER, SMTP_PASSWORD)
+    return smtp
+
+
+# Emails are only put in the outbox here; mailer.py sends them, so nobody waits on the SMTP server. to may be a list.
 def send_smtp(to, content):
-    try:
-        with get_smtp_client() as smtp:
-            smtp.login(SMTP_USER, SMTP_PASSWORD)
-            smtp.sendmail(SMTP_USER, to, content)
-    except smtplib.SMTPResponseException as e:
-        logging.error("SMTP Error: " + str(e))
+    db.push_mail({'to': to, 'content': content, 'attempts': 0})
 
 
 def prepare_email(to, subject, content):
@@ -61,13 +73,57 @@ def send_error_to_user(email, message, tb, lcs):
     return send_email(email, 'An Error Happened.', EXCEPTION_FORMAT % (message, compress_traceback(tb, lcs)))
 
 
+def send_quota_warning_to_user(email, target_name, paths):
+    listed_paths = '\n'.join(paths[:20]) + ('\n...' if len(paths) > 20 else '')
+    return send_email(email, 'Not Enough Space.', QUOTA_FORMAT % (target_name, len(paths), listed_paths))
+
+
 def send_emergency_code_to_user(email, user_id, auth_code):
     return send_email(email, 'Your Emergency Login Link', EMERGENCY_LOGIN_FORMAT % (user_id, auth_code))
 
 
+def send_to_admins(subject, content):  # One email to all the admins
+    return send_smtp(ADMIN_EMAILS, prepare_email(', '.join(ADMIN_EMAILS), 'NUSync: ' + subject, content + SIGN).as_string())
+
+
+def describe_frame(frame):
+    (filename, lineno, name, _) = frame
+    return '%s:%d (%s)' % (os.path.basename(filename), lineno, name)
+
+
+# The same failure happening for many users or files looks the same here: the exception type, where it was raised and where it
+# was caught. Must be called while handling the exception.
+def error_fingerprint(caller):
+    (exc_type, _, exc_tb) = sys.exc_info()
+    if exc_type is None:
+        return 'Error reported from %s' % describe_frame(traceback.extract_stack(caller, limit=1)[-1])
+    return '%s raised in %s, caught in %s' % (exc_type.__name__, describe_frame(traceback.extract_tb(exc_tb)[-1]),
+                                              describe_frame(traceback.extract_stack(caller, limit=1)[-1]))
+
+
+# Only the first error of a kind in ERROR_MAIL_WINDOW is mailed straight away. The others are counted for the digest, and the
+# locals of only the first few are formatted and kept as samples.
 def send_error_to_admin(tb, lcs):
-    for email in ADMIN_EMAILS:
-        send_email(email, 'Error', "Locals = %s\n%s" % (lcs, tb))
+    fingerprint = error_fingerprint(sys._getframe(1))
+    (count, first) = db.count_error(fingerprint, ERROR_MAIL_WINDOW)
+    if first:
+        return send_to_admins('Error', "%s\n\nLocals = %s\n%s" % (fingerprint, lcs, tb))
+    if count <= ERROR_DIGEST_SAMPLES:
+        db.add_error_sample(fingerprint, "Locals = %s\n%s" % (lcs, tb))
+
+
+# Called by the scheduler every ERROR_DIGEST_INTERVAL.
+def send_error_digest():
+    errors = db.pop_errors()
+    if not errors:
+        return
+    fingerprints = sorted(errors, key=lambda fingerprint: errors[fingerprint][0], reverse=True)
+    content = '%d errors since the last digest:\n\n' % sum(count for count, _ in errors.values())
+    content += '\n'.join('%6d  %s' % (errors[fingerprint][0], fingerprint) for fingerprint in fingerprints)
+    for fingerprint in fingerprints:
+        if errors[fingerprint][1]:
+            content += '\n\n\n%s\n\n' % fingerprint + '\n\n'.join(errors[fingerprint][1])
+    return send_to_admins('Error Digest', content)
 
 
 def compress_traceback(tb, lcs):
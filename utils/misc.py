@@ -1,4 +1,4 @@
-import mimetypes, random, string
+import collections, mimetypes, random, string, threading
 
 def module_code_safe_check(module_code):  # TODO: All these safe check functions are dangerous.
     return module_code.replace('/', '_')
@@ -15,3 +15,32 @@ def get_mime_type(filename):
 def generate_random_string(length):
     return ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits) for _ in range(length))
 
+
+
+class LRUCache():
+    # A small thread-safe LRU map, used to keep API clients around between files within a process.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, factory):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        value = factory()  # Outside the lock, building a client may take a round trip
+        with self.lock:
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [key for key in self.items if predicate(key)]:
+                del self.items[key]
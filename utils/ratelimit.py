@@ -0,0 +1,87 @@
+import random
+import threading
+import time
+from utils import db
+from config import RATE_LIMITS, USER_RATE_LIMITS, RATE_LIMIT_MAX_WAIT, BACKOFF_BASE, BACKOFF_MAX, SERVER_ERROR_WINDOW, \
+    SERVER_ERROR_LIMIT, PROVIDER_SERVER_ERROR_LIMIT
+
+# Buckets this process has seen throttled, so that a successful request only goes to Redis to reset their backoff when there is
+# something to reset.
+backing_off = set()
+backing_off_lock = threading.Lock()
+
+
+# Raised instead of making a request when a provider is throttling us for longer than RATE_LIMIT_MAX_WAIT, or when it has just
+# throttled the request. retry_after is how long to leave it alone.
+class RateLimitedException(Exception):
+    def __init__(self, provider, retry_after):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__("%s is rate limited, retry after %.0fs." % (provider, retry_after))
+
+
+# Requests to a provider are counted in token buckets shared by every worker: one for the whole provider (RATE_LIMITS) and one per
+# user credential (USER_RATE_LIMITS), which is a hash of the credential so that the token does not end up in a key name.
+def bucket_names(provider, credential_key=None):
+    if credential_key is None or provider not in USER_RATE_LIMITS:
+        return [provider]
+    return [provider, '%s:%s' % (provider, credential_key)]
+
+
+def bucket_limits(names):
+    return [RATE_LIMITS[names[0]]] + [USER_RATE_LIMITS[names[0]]] * (len(names) - 1)
+
+
+# Waits for a token in all the buckets, sleeping when the wait is short and giving up when it is not.
+def acquire(names):
+    limits = bucket_limits(names)
+    waited = 0
+    while True:
+        wait = db.take_tokens(names, limits)
+        if wait <= 0:
+            return
+        if waited + wait > RATE_LIMIT_MAX_WAIT:
+            raise RateLimitedException(names[0], wait)
+        wait *= random.uniform(1, 1.2)  # So that the workers woken up do not all come back at once
+        time.sleep(wait)
+        waited += wait
+
+
+# Called when the provider throttles or fails a request. Retry-After is honoured when the provider sends it, otherwise the
+# bucket backs off exponentially with jitter; the failure count is forgotten after a quiet BACKOFF_MAX * 4.
+def throttle(name, retry_after=None):
+    failures = db.count_rate_limit_failure(name, BACKOFF_MAX * 4)
+    with backing_off_lock:
+        backing_off.add(name)
+    if retry_after is None:
+        retry_after = min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX) * random.uniform(0.5, 1)
+    db.block_rate_limit(name, time.time() + retry_after)
+    return retry_after
+
+
+# Called after a request went through, so the next throttling starts backing off from BACKOFF_BASE again.
+def succeeded(names):
+    with backing_off_lock:
+        names = [name for name in names if name in backing_off]
+        backing_off.difference_update(names)
+    if names:
+        db.reset_rate_limit_failures(names)
+
+
+# Server errors happen now and then, and a request which gets one simply fails (the file is tried again later). Only
+# SERVER_ERROR_LIMIT of them for one credential within SERVER_ERROR_WINDOW back that credential off, and the whole provider only
+# once it has PROVIDER_SERVER_ERROR_LIMIT of them. Returns how long to back off, or None if the request should just fail.
+def server_error(names, retry_after=None):
+    counts = db.count_server_errors(names, SERVER_ERROR_WINDOW)
+    if counts[0] >= PROVIDER_SERVER_ERROR_LIMIT:
+        return throttle(names[0], retry_after)
+    if len(names) > 1 and counts[-1] >= SERVER_ERROR_LIMIT:
+        return throttle(names[-1], retry_after)
+    return None
+
+
+def parse_retry_after(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):  # Missing, or an HTTP date which none of the providers send
+        return None
@@ -1,54 +1,76 @@
+import collections
 import rq
+import rq.job
+import rq.utils
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import ConnectionError
 
 import models
-from utils import db, mail
+from utils import db, mail, ratelimit
 from config import *
 from drivers import drivers, SyncException
+from utils.fairqueue import DeficitRoundRobin
 import api.ivle
 
 user_queue = rq.Queue('user', connection=db.r)
 file_queue = rq.Queue('file', connection=db.r)
+file_dispatcher = DeficitRoundRobin(FILE_QUEUE_QUANTUM)
+# Shared by every job the worker runs, so the per thread clients in drivers.py are reused across batches instead of being left
+# behind with the threads of each one.
+transfer_executor = ThreadPoolExecutor(max_workers=FILE_TRANSFER_CONCURRENCY)
 
 
-def queue_all_user():
-    for user_name in db.get_users():
-        user_name = user_name.decode("utf-8")
-        if models.User(user_name).enabled and (not user_queue.fetch_job(user_name) or user_queue.fetch_job(user_name).status == 'finished'):
-            user_queue.enqueue_call(func=do_user, args=(user_name,), job_id=user_name)
+# Every field a sync or transfer job reads, loaded in one round trip at the start instead of one HGET each.
+JOB_USER_FIELDS = ('enabled', 'target', 'target_settings', 'ivle_token', 'modules', 'uploadable_folder', 'email')
 
 
-def do_user(user_name):
+def queue_users(user_names, due_times=None):
+    # Job statuses are read in one pipelined round trip and all new jobs are written in another, instead of loading every user
+    # and fetching its job one by one. Same rule as before: only queue a user with no job yet or whose last job has finished.
+    pipe = db.r.pipeline(transaction=False)
+    for user_name in user_names:
+        pipe.hget(rq.job.Job.key_for(user_name), 'status')
+    statuses = pipe.execute()
+    pipe = db.r.pipeline(transaction=False)
+    pipe.sadd(user_queue.redis_queues_keys, user_queue.key)
+    for user_name, status in zip(user_names, statuses):
+        if status is None or status.decode('utf-8') == rq.job.JobStatus.FINISHED:
+            job = rq.job.Job.create(do_user, args=(user_name, (due_times or {}).get(user_name)), connection=db.r, status=rq.job.JobStatus.QUEUED,
+                                    timeout=user_queue.DEFAULT_TIMEOUT, id=user_name, origin=user_queue.name)
+            job.enqueued_at = rq.utils.utcnow()
+            job.save(pipeline=pipe)
+            user_queue.push_job_id(job.id, pipeline=pipe)
+    pipe.execute()
+
+
+def do_user(user_name, due=None):
+    if due is not None:
+        db.set_schedule_lag(user_name, max(0, time.time() - due))
     user = models.User(user_name)
-    with user.lock:
-        user.sync_from_db()
-        try:
-            if not (user.enabled and drivers[user.target].check_settings(user.target_settings)):
-                return  # Drivers should always return True or throw Exception. This means user disabled somewhere, we skip the user.
-        except SyncException as e:
-            if e.disable_user:
-                user.enabled = False
-                user.update()
-            if e.logout_user:
-                user.last_target = user.target
-                user.target = None
-                user.update()
-            if e.send_email:
-                mail.send_error_to_user(user.email, e.message, traceback.format_exc(), locals())
-            else:
-                mail.send_error_to_admin(traceback.format_exc(), locals())
-            return
-        except Exception as e:
-            mail.send_error_to_admin(traceback.format_exc(), locals())  # TODO
-            return
+    user.load(*JOB_USER_FIELDS)
+    try:
+        if not (user.enabled and drivers[user.target].verify_settings(user.target_settings, refresh=True)):
+            return  # Drivers should always return True or throw Exception. This means user disabled somewhere, we skip the user.
+    except SyncException as e:
+        if e.disable_user:
+            user.disable()
+        if e.logout_user:
+            user.logout_target()
+        if e.send_email:
+            mail.send_error_to_user(user.email, e.message, traceback.format_exc(), locals())
+        elif e.retry_after is None:  # Being throttled is not worth telling anyone about
+            mail.send_error_to_admin(traceback.format_exc(), locals())
+        return
+    except Exception as e:
+        mail.send_error_to_admin(traceback.format_exc(), locals())  # TODO
+        return
     try:
         if not api.ivle.validate_token(user):
             mail.send_email(user.email, 'IVLE Login Expired.', "Your IVLE login has expired. Please refresh by accessing our page and re-enable syncing.")
-            with user.lock:
-                user.sync_from_db()
-                user.enabled = False
-                user.update()
+            user.disable()
             return
     except Exception as e:
         mail.send_error_to_admin(traceback.format_exc(), locals())  # TODO
@@ -56,69 +78,222 @@ def do_user(user_name):
 
     try:
         file_list = api.ivle.read_all_file_list(user)
-    except ConnectionError as e:
+    except (ConnectionError, ratelimit.RateLimitedException) as e:
         return
     except Exception as e:
         mail.send_error_to_admin(traceback.format_exc(), locals())
         return  # TODO: Should be Json Parsing Exception & Network Exception - We skip the user and inform the admin
+    if db.replace_listed_files(user_name, [file['ID'] for file in file_list]):
+        # Only files new to IVLE keep the user on the short sync interval (see scheduler.py), not ones which do not fit or keep failing
+        db.set_last_change(user_name, time.time())
+
+    if db.is_reconcile_pending(user_name):
+        try:
+            reconcile_files(user, file_list)
+        except (SyncException, ratelimit.RateLimitedException) as e:
+            return  # Try again next time rather than upload everything
+        except Exception as e:
+            # Most likely the provider or the connection failing for a moment, so again next time; only after RECONCILE_MAX_ATTEMPTS
+            # is the listing given up on and everything not in the synced files uploaded.
+            if db.count_reconcile_failure(user_name) >= RECONCILE_MAX_ATTEMPTS:
+                mail.send_error_to_admin(traceback.format_exc(), locals())
+                db.clear_reconcile_pending(user_name)
+            return
+
+    unsynced_files = user.filter_unsynced_files(file_list)
+    files = user.filter_unqueued_files(unsynced_files)
+    if files:
+        queued_ids = {file['ID'] for file in files}
+        # Files already queued, delayed or being transferred have not taken up any space in the target yet, but will
+        files = fit_free_space(user, files, sum(file['size'] for file in unsynced_files if file['ID'] not in queued_ids))
+        if files:
+            queue_files(user, files)
+
+
+TARGET_NAMES = {'dropbox': 'Dropbox', 'google': 'Google Drive', 'onedrive': 'OneDrive'}
+
+
+# Asks the target for its free space once before queueing. The newest files get the space there is, less reserved bytes for the
+# files still on their way, and the rest are not queued, as they would only be downloaded from IVLE to fail on upload; the user is
+# told at most once every QUOTA_NOTIFY_INTERVAL.
+def fit_free_space(user, files, reserved=0):
+    try:
+        free_space = drivers[user.target].get_free_space(user.target_settings)
+    except Exception as e:  # Only a pre-flight check, the uploads still handle running out of space
+        return files
+    if free_space is None:
+        return files
+    free_space -= reserved
+    fitting_files, skipped_files = [], []
+    for file in sorted(files, key=lambda file: file.get('uploaded', 0), reverse=True):
+        if file['size'] <= free_space:
+            fitting_files.append(file)
+            free_space -= file['size']
+        else:
+            skipped_files.append(file)
+    if skipped_files and db.claim_quota_notification(user.user_id, QUOTA_NOTIFY_INTERVAL):
+        mail.send_quota_warning_to_user(user.email, TARGET_NAMES.get(user.target, user.target), [file['path'] for file in skipped_files])
+    return fitting_files
+
 
-    for file in file_list:
-        if file['ID'] not in user.synced_files and not file_queue.fetch_job('%s:%s' % (user_name, file['ID'])):
-            file_queue.enqueue_call(func=do_file, args=(user_name, file['ID'], file['path'], file['size']), job_id='%s:%s' % (user_name, file['ID']),
-                                    timeout=-1)
+# After logging in again the synced files are gone, but most of the files are likely still in the target. One listing of the
+# target marks those with the same path and size as synced, instead of uploading them all again.
+def reconcile_files(user, file_list):
+    driver = drivers[user.target]
+    existing_files = driver.list_files(user.target_settings)
+    user.mark_files_synced([file['ID'] for file in file_list if existing_files.get(driver.path_key(file['path'])) == file['size']])
+    db.clear_reconcile_pending(user.user_id)
 
 
-def do_file(user_name, file_id, file_path, file_size):
+def queue_files(user, files):
+    # Small files first, so fresh lecture notes are not stuck behind a backfill of recordings.
+    files = sorted(files, key=lambda file: file['size'])
+    batches = []
+    for i in range(0, len(files), FILE_BATCH_SIZE):
+        batch = files[i:i + FILE_BATCH_SIZE]
+        batches.append({'files': batch, 'queued_at': time.time(), 'cost': sum(file['size'] + FILE_OVERHEAD_COST for file in batch)})
+    user.set_files_status([file['ID'] for file in files], 'pending')
+    db.push_file_batches(user.user_id, batches)
+
+
+# Files put off because their provider was throttling us, see transfer_file.
+def queue_delayed_files():
+    files_by_user = {}
+    for user_name, file in db.pop_due_delayed_files(time.time()):
+        files_by_user.setdefault(user_name, []).append(file)
+    for user_name, files in files_by_user.items():
+        queue_files(models.User(user_name), files)
+
+
+# Batches wait in a list per user and are moved to the file queue by the scheduler, by deficit round robin across the users,
+# keeping no more than FILE_QUEUE_DEPTH jobs in it so that a user with a big backlog cannot hold up everybody else.
+def dispatch_file_batches():
+    free = FILE_QUEUE_DEPTH - file_queue.count
+    users = db.get_pending_users()
+    if free <= 0 or not users:
+        return 0
+
+    # The first batch of every user is read once for the whole call, and a user's is only read again after it has been dispatched,
+    # rather than once per round.
+    costs = {user_name: batch['cost'] if batch is not None else None for user_name, batch in zip(users, db.peek_file_batches(users))}
+
+    def head_cost(user_name):
+        if user_name not in costs:
+            batch = db.peek_file_batch(user_name)
+            costs[user_name] = batch['cost'] if batch is not None else None
+        if costs[user_name] is None:
+            db.remove_pending_user_if_empty(user_name)
+        return costs[user_name]
+
+    def pop(user_name):
+        batch = db.pop_file_batch(user_name)
+        del costs[user_name]
+        if batch is not None:
+            db.set_files_status(user_name, [file['ID'] for file in batch['files']], 'queued')  # Only now can the job go missing
+            file_queue.enqueue_call(func=do_files, args=(user_name, batch['files'], batch['queued_at']), timeout=-1)
+
+    return file_dispatcher.dispatch(users, head_cost, pop, free)
+
+
+def do_file(user_name, file_id, file_path, file_size):  # Jobs queued before files were batched
+    do_files(user_name, [{'ID': file_id, 'path': file_path, 'size': file_size}])
+
+
+def do_files(user_name, files, queued_at=None):
+    # The user is loaded and the IVLE token is validated once per batch; target settings are only checked against the provider once
+    # thanks to verify_settings. Each file still succeeds, is retried or is given up on its own.
+    if queued_at is not None:
+        db.set_file_queue_wait(user_name, max(0, time.time() - queued_at))
     user = models.User(user_name)
-    url = api.ivle.get_file_url(user, file_id)
-    if file_id in user.synced_files:
-        return
+    user.load(*JOB_USER_FIELDS)  # Before the transfer threads start reading them off the same user
+    remaining = collections.deque(files)
     try:
-        if not (user.enabled and drivers[user.target].check_settings(user.target_settings)):
+        if not api.ivle.validate_token(user):
+            mail.send_email(user.email, 'IVLE Login Expired.', "Your IVLE login has expired. Please refresh by accessing our page and re-enable syncing.")
+            user.disable()
             return
+        retry_after = transfer_files(user, remaining)
+        if retry_after is not None:  # Throttled, the rest of the batch waits as well
+            user.delay_files(list(remaining), retry_after)
+            remaining.clear()
+    except Exception as e:
+        mail.send_error_to_admin(traceback.format_exc(), locals())
+    finally:
+        user.clear_files_status([file['ID'] for file in remaining])
+
+
+# Transfers are almost all waiting on IVLE and the provider, so a job runs up to FILE_TRANSFER_CONCURRENCY of them at once in
+# threads, each holding at most a chunk or two in memory. Files are taken off remaining as they are started; once the user is
+# disabled or logged out, or the provider throttles us, no more are started and what is left stays in remaining.
+# Returns how long to wait before trying the rest if the provider is throttling us.
+def transfer_files(user, remaining):
+    stopped = threading.Event()
+    retry_after = []
+
+    def transfer_next():
+        while not stopped.is_set():
+            try:
+                file = remaining.popleft()
+            except IndexError:
+                return
+            try:
+                if not transfer_file(user, file['ID'], file['path'], file['size']):
+                    stopped.set()  # The user has been disabled or logged out, the rest will be queued again by the next sync
+            except SyncException as e:
+                retry_after.append(e.retry_after)
+                stopped.set()
+
+    try:
+        for future in [transfer_executor.submit(transfer_next) for _ in range(min(FILE_TRANSFER_CONCURRENCY, len(remaining)))]:
+            future.result()
+    finally:
+        stopped.set()  # If the job is timed out while waiting, the threads start no more of its files
+    return max(retry_after) if retry_after else None
+
+
+# Returns False if the rest of the batch should not be attempted. Raises the SyncException if the provider is throttling us, after
+# putting the file off until it is expected to stop.
+def transfer_file(user, file_id, file_path, file_size):
+    source = api.ivle.WorkbinFile(user, file_id, file_size)
+    if user.is_file_synced(file_id):
+        user.clear_files_status([file_id])  # Already taken off remaining, so do_files will not clear it
+        return True
+    user.set_files_status([file_id], 'transferring')
+    delayed = False
+    try:
+        if not (user.enabled and drivers[user.target].verify_settings(user.target_settings)):
+            return False
         if file_size > GLOBAL_MAX_FILE_SIZE or file_size > drivers[user.target].MAX_FILE_SIZE:
             raise SyncException(
                 'File %s is too big to be automatically transferred. Please manually download it <a href="%s">here</a>. Sorry for the inconvenience!' % (
-                    file_path, url), retry=False, send_email=True, disable_user=False, logout_user=False)
-        if not api.ivle.validate_token(user):
-            mail.send_email(user.email, 'IVLE Login Expired.', "Your IVLE login has expired. Please refresh by accessing our page and re-enable syncing.")
-            with user.lock:
-                user.sync_from_db()
-                user.enabled = False
-                user.update()
-            return
-        if drivers[user.target].transport_file(user, url, file_path):
-            with user.lock:
-                user.sync_from_db()
-                user.synced_files.append(file_id)
-                user.update()
+                    file_path, source.url), retry=False, send_email=True, disable_user=False, logout_user=False)
+        if drivers[user.target].transport_file(user, source, file_path):
+            user.mark_file_synced(file_id)
         else:
             raise SyncException("transport_file returned False", retry=True, send_email=False, disable_user=False, logout_user=False)
     except SyncException as e:
+        if e.retry_after is not None:
+            user.delay_files([{'ID': file_id, 'path': file_path, 'size': file_size}], e.retry_after)
+            delayed = True
+            raise
         if not e.retry:
-            with user.lock:
-                user.sync_from_db()
-                user.synced_files.append(file_id)
-                user.update()
+            user.mark_file_synced(file_id)
         if e.send_email:
             mail.send_error_to_user(user.email, e.message, traceback.format_exc(), locals())
         else:
             mail.send_error_to_admin(traceback.format_exc(), locals())
         if e.disable_user:
-            with user.lock:
-                user.sync_from_db()
-                user.enabled = False
-                user.update()
+            user.disable()
         if e.logout_user:
-            with user.lock:
-                user.sync_from_db()
-                user.last_target = user.target
-                user.target = None
-                user.update()
-        return
+            user.logout_target()
+        return not (e.disable_user or e.logout_user)
     except api.ivle.IVLEUnknownErrorException as e:
         mail.send_error_to_admin(traceback.format_exc(), locals())
-        return  # TODO: Walao eh IVLE bug again, skip it and inform the admin
+        return True  # TODO: Walao eh IVLE bug again, skip it and inform the admin
     except Exception as e:
         mail.send_error_to_admin(traceback.format_exc(), locals())
-        return
+        return True
+    finally:
+        if not delayed:
+            user.clear_files_status([file_id])
+    return True